@@ -0,0 +1,412 @@
+# coding=utf-8
+"""
+Benchmarks for the upload analysis and the thumbnail pipeline.
+
+    python benchmarks/bench_lcd.py                        # 10 and 100 MB files, OrcaSlicer and Cura
+    python benchmarks/bench_lcd.py --sizes 10 250 500     # file sizes in MB (10-500)
+    python benchmarks/bench_lcd.py --save-baseline        # store the results as the new baseline
+
+Cases:
+  preprocess          file_preprocessor + the analysis job it schedules, on a stored file
+  extract_thumbnail   extract_thumbnail_from_content over the whole file as text
+  pixel_data          get_pixel_data of a 96x96 thumbnail
+  thumb_commands_*    command lines built for send_image_to_marlin, hex only / compact encodings
+
+Synthetic OrcaSlicer and Cura files with an embedded 96x96 PNG thumbnail are
+generated once per size into --data-dir and reused. Every case runs in its own
+interpreter, so the reported peak RSS belongs to that case alone. Results are
+compared against benchmarks/baseline.json (if present): lower throughput or
+higher peak RSS than the tolerance allows is a regression and makes the run exit
+with status 1. Baselines are machine specific, record them on the machine that
+runs the comparison.
+
+Needs the plugin's environment (OctoPrint and Pillow).
+"""
+from __future__ import absolute_import
+
+import io
+import os
+import sys
+import json
+import time
+import base64
+import random
+import logging
+import argparse
+import tempfile
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+SLICERS = ("orca", "cura")
+FILE_CASES = ("preprocess", "extract_thumbnail")
+THUMB_CASES = ("pixel_data", "thumb_commands_hex", "thumb_commands_compact")
+
+# Iterations per timed run of the thumbnail cases
+THUMB_ITERATIONS = 200
+
+# Peak RSS differences below this are noise (allocator, page cache accounting)
+RSS_SLACK_MB = 8.0
+
+
+# -----------------------
+# Synthetic G-code
+# -----------------------
+def make_thumbnail_png(seed=96):
+    """Deterministic 96x96 PNG, a gradient with a few shapes like a rendered plate."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (96, 96))
+    image.putdata([(x * 2, y * 2, 96) for y in range(96) for x in range(96)])
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y, r = rng.randrange(10, 86), rng.randrange(10, 86), rng.randrange(4, 16)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _thumbnail_block(png):
+    b64 = base64.b64encode(png).decode("ascii")
+    lines = [f"; thumbnail begin 96x96 {len(b64)}"]
+    lines += [f"; {b64[i:i + 78]}" for i in range(0, len(b64), 78)]
+    lines.append("; thumbnail end")
+    return "\n".join(lines) + "\n"
+
+
+def _layer_body(rng, moves=2000):
+    lines = [";TYPE:Outer wall"]
+    for i in range(moves):
+        x, y = rng.uniform(20, 200), rng.uniform(20, 200)
+        lines.append(f"G1 X{x:.3f} Y{y:.3f} E{rng.uniform(0.01, 0.09):.5f}")
+        if i % 50 == 0:
+            lines.append(f"G0 F12000 X{x + 1:.3f} Y{y:.3f}")
+    return "\n".join(lines) + "\n"
+
+
+def write_gcode(path, slicer, size_mb, seed=1):
+    """Write a synthetic G-code file of about size_mb megabytes, layer by layer."""
+    rng = random.Random(seed)
+    body = _layer_body(rng)
+    layers = max(int(size_mb * 1024 * 1024 // len(body)), 1)
+    minutes = layers * 2
+    thumbnail = _thumbnail_block(make_thumbnail_png())
+
+    with open(path + ".tmp", "w", encoding="ascii", newline="\n") as f:
+        if slicer == "orca":
+            f.write("; HEADER_BLOCK_START\n; generated by OrcaSlicer 2.1.1 on 2025-01-01 at 12:00:00\n")
+            f.write(f"; total layer number: {layers}\n; HEADER_BLOCK_END\n\n")
+            f.write("; THUMBNAIL_BLOCK_START\n;\n" + thumbnail + ";\n; THUMBNAIL_BLOCK_END\n\n")
+        else:
+            f.write(f";FLAVOR:Marlin\n;TIME:{minutes * 60}\n;Layer height: 0.2\n")
+            f.write(";Generated with Cura_SteamEngine 5.6.0\n" + thumbnail + f";LAYER_COUNT:{layers}\n")
+        f.write(f"M73 P0 R{minutes}\nG28\n")
+
+        for layer in range(layers):
+            z = 0.2 * (layer + 1)
+            if slicer == "orca":
+                f.write(f";LAYER_CHANGE\n;Z:{z:.2f}\n;HEIGHT:0.2\nG1 Z{z:.2f} F720\n")
+            else:
+                f.write(f";LAYER:{layer}\nG0 F12000 Z{z:.2f}\n")
+            f.write(f"M73 P{layer * 100 // layers} R{minutes - layer * minutes // layers}\n")
+            f.write(body)
+
+        f.write("M73 P100 R0\nM104 S0\nM140 S0\nM84\n")
+        if slicer == "orca":
+            f.write("; CONFIG_BLOCK_START\n; print_settings_id = 0.20mm Standard @Creality Ender3V3SE 0.4 nozzle\n")
+            f.write("; CONFIG_BLOCK_END\n")
+        else:
+            f.write(";End of Gcode\n;SETTING_3 {\"global_quality\": \"[general]\\\\nversion = 4\"}\n")
+    os.replace(path + ".tmp", path)
+
+
+def ensure_gcode(data_dir, slicer, size_mb):
+    path = os.path.join(data_dir, f"{slicer}_{size_mb}mb.gcode")
+    if not os.path.exists(path):
+        print(f"Generating {path} ...", file=sys.stderr)
+        write_gcode(path, slicer, size_mb)
+    return path
+
+
+# -----------------------
+# Plugin fixture
+# -----------------------
+# What OctoPrint injects into a loaded plugin, reduced to the calls these code paths make.
+class _BenchSettings(object):
+    def __init__(self, defaults):
+        self._values = dict(defaults)
+
+    def get(self, path):
+        return self._values.get(path[0])
+
+    def get_int(self, path):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def get_boolean(self, path):
+        return bool(self.get(path))
+
+    def global_get_boolean(self, path):
+        return False
+
+
+class _BenchPrinter(object):
+    def is_printing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+    def is_operational(self):
+        return True
+
+    def commands(self, commands, tags=None):
+        pass
+
+
+class _BenchFileManager(object):
+    def __init__(self, root):
+        self.root = root
+
+    def path_on_disk(self, storage, path):
+        return os.path.join(self.root, path)
+
+
+class _BenchPluginManager(object):
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+class _BenchFile(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def make_plugin(root, caps=None):
+    sys.path.insert(0, REPO_ROOT)
+    import octoprint_LCD_E3V3SE as lcd
+    from octoprint_LCD_E3V3SE.metadata_store import MetadataStore
+
+    plugin = lcd.LCD_E3V3SEPlugin()
+    plugin._identifier = "LCD_E3V3SE"
+    plugin._settings = _BenchSettings(plugin.get_settings_defaults())
+    plugin._printer = _BenchPrinter()
+    plugin._file_manager = _BenchFileManager(root)
+    plugin._plugin_manager = _BenchPluginManager()
+    plugin._plugin_logger.setLevel(logging.WARNING)
+    plugin.initialize()
+    plugin.metadata_store = MetadataStore(os.path.join(tempfile.mkdtemp(prefix="lcd_bench_"), "metadata.db"))
+    plugin.thumb_caps = caps or {}
+    return plugin
+
+
+# -----------------------
+# Cases (run in the child process)
+# -----------------------
+def _best_of(repeat, run):
+    # One untimed run first: imports, thread pools, SQLite and the page cache warm up
+    run()
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def case_preprocess(path, repeat):
+    root, name = os.path.split(path)
+    plugin = make_plugin(root)
+
+    def run():
+        plugin.file_preprocessor(name, _BenchFile(name), None, None, True)
+        if plugin.wait_analysis(name) is None:
+            raise RuntimeError(f"analysis of {name} failed")
+
+    return os.path.getsize(path), _best_of(repeat, run)
+
+
+def case_extract_thumbnail(path, repeat):
+    plugin = make_plugin(os.path.dirname(path))
+
+    def run():
+        # Same as the legacy upload path: the whole file decoded to text first
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if not plugin.extract_thumbnail_from_content(content):
+            raise RuntimeError("no thumbnail found")
+
+    return os.path.getsize(path), _best_of(repeat, run)
+
+
+def case_pixel_data(repeat):
+    from PIL import Image
+
+    plugin = make_plugin(tempfile.gettempdir())
+    image = Image.open(io.BytesIO(make_thumbnail_png()))
+    image.load()
+
+    def run():
+        for _ in range(THUMB_ITERATIONS):
+            plugin.get_pixel_data(image)
+
+    return THUMB_ITERATIONS, _best_of(repeat, run)
+
+
+def _thumb_commands(caps, repeat):
+    from PIL import Image
+
+    sys.path.insert(0, REPO_ROOT)
+    from octoprint_LCD_E3V3SE.thumbnail import to_be_bytes
+
+    plugin = make_plugin(tempfile.gettempdir(), caps)
+    payload = to_be_bytes(plugin.get_pixel_data(Image.open(io.BytesIO(make_thumbnail_png()))))
+    encodings = plugin.get_thumb_encodings()
+
+    def run():
+        for i in range(THUMB_ITERATIONS):
+            plugin._build_thumb_lines(payload, "M9001", encodings, numbered_mode=bool(i % 2))
+
+    return THUMB_ITERATIONS, _best_of(repeat, run)
+
+
+def case_thumb_commands_hex(repeat):
+    return _thumb_commands({}, repeat)
+
+
+def case_thumb_commands_compact(repeat):
+    return _thumb_commands({"enc": "HEX,B64,RLE", "maxlen": "96"}, repeat)
+
+
+def _peak_rss_mb():
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def run_case(case, path, repeat):
+    base_rss = _peak_rss_mb()
+    if case in FILE_CASES:
+        size, seconds = globals()[f"case_{case}"](path, repeat)
+        result = {"throughput": size / (1024.0 * 1024.0) / seconds, "unit": "MB/s"}
+    else:
+        ops, seconds = globals()[f"case_{case}"](repeat)
+        result = {"throughput": ops / seconds, "unit": "ops/s"}
+    result.update(seconds=seconds, peak_rss_mb=_peak_rss_mb(), base_rss_mb=base_rss)
+    return result
+
+
+# -----------------------
+# Driver
+# -----------------------
+def spawn_case(case, path, repeat):
+    command = [sys.executable, os.path.abspath(__file__), "--case", case, "--repeat", str(repeat)]
+    if path:
+        command += ["--file", path]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"case {case} failed with status {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(key, result, baseline, tolerance):
+    """Regression messages for one result against its baseline entry."""
+    reference = baseline.get(key)
+    if not reference:
+        return []
+    problems = []
+    if result["throughput"] < reference["throughput"] * (1 - tolerance):
+        problems.append(
+            f"{key}: throughput {result['throughput']:.1f} {result['unit']} < "
+            f"baseline {reference['throughput']:.1f} -{tolerance:.0%}"
+        )
+    if result["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + tolerance) + RSS_SLACK_MB:
+        problems.append(
+            f"{key}: peak RSS {result['peak_rss_mb']:.1f} MB > baseline {reference['peak_rss_mb']:.1f} MB +{tolerance:.0%}"
+        )
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100], help="file sizes in MB")
+    parser.add_argument("--slicers", nargs="+", choices=SLICERS, default=list(SLICERS))
+    parser.add_argument("--cases", nargs="+", choices=FILE_CASES + THUMB_CASES, default=list(FILE_CASES + THUMB_CASES))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the best one counts")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "lcd_e3v3se_bench"))
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    # Internal: run a single case in this process and print its result
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--file", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.file, args.repeat)))
+        return 0
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    runs = []
+    for case in args.cases:
+        if case in FILE_CASES:
+            for slicer in args.slicers:
+                for size_mb in args.sizes:
+                    runs.append((f"{case}[{slicer}-{size_mb}MB]", case, ensure_gcode(args.data_dir, slicer, size_mb)))
+        else:
+            runs.append((case, case, None))
+
+    results = {}
+    print(f"{'case':<36} {'throughput':>16} {'best (s)':>10} {'peak RSS (MB)':>14}")
+    for key, case, path in runs:
+        result = spawn_case(case, path, args.repeat)
+        results[key] = result
+        print(
+            f"{key:<36} {result['throughput']:>10.1f} {result['unit']:<5} "
+            f"{result['seconds']:>10.3f} {result['peak_rss_mb']:>14.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(
+            {key: {k: r[k] for k in ("throughput", "unit", "peak_rss_mb")} for key, r in results.items()}
+        )
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    problems = []
+    for key, result in results.items():
+        problems += compare(key, result, baseline, args.tolerance)
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
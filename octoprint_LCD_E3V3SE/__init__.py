@@ -3,14 +3,18 @@ from __future__ import absolute_import
 
 import math
 import io
+import queue
 import os
-import re
 import json
 import time
 import base64
 import inspect
 import logging
+import logging.handlers
 import threading
+import functools
+import concurrent.futures
+import collections
 
 from PIL import Image
 from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
@@ -18,10 +22,22 @@ from octoprint.logging.handlers import CleaningTimedRotatingFileHandler
 import octoprint.plugin
 import octoprint.filemanager
 import octoprint.filemanager.util
+from octoprint.util import RepeatedTimer
+
+from .log_utils import RateLimitFilter, loggable
+from .gcode_scanner import (
+    scan_content, scan_file, scan_layer_index, encode_offsets, decode_offsets, layer_at, remaining_at,
+)
+from .metadata_store import MetadataStore
+from .print_history import PrintHistory
+from .thumbnail import (
+    chunk_budget, iter_row_chunks, payload_hash, rgb565_array, rgb565_bytes, thumb_geometry, to_be_bytes
+)
 
 
 class LCD_E3V3SEPlugin(
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.filemanager.util.LineProcessorStream,
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.ProgressPlugin,
@@ -32,7 +48,19 @@ class LCD_E3V3SEPlugin(
     def __init__(self):
         # --- Core state ---
         self.plugin_data_folder = None
-        self.metadata_dir = None
+        self.metadata_dir = None          # legacy per-file JSON metadata
+        self.metadata_store = None
+        self._metadata_gc_timer = None
+        self.print_history = None         # predicted vs actual durations of finished prints
+
+        # --- Upload analysis jobs (path -> Future with the metadata, started once the file is saved) ---
+        self._analysis_pool = None
+        self._analysis_jobs = {}
+
+        # --- Backfill indexer (files that never went through the preprocessor) ---
+        self._index_pool = None
+        self._index_lock = threading.Lock()
+        self._index_pending = set()
 
         self.file_name = None
         self.file_path = None
@@ -40,11 +68,30 @@ class LCD_E3V3SEPlugin(
         self.print_time = None
         self.progress = None
         self.myETA = None
+        self.slicer = None
+        self.print_profile = None
+        self._eta_factor = 1.0            # history correction for the slicer's time estimates
 
         self.is_lcd_ready = False
         self.current_layer = 0
         self.total_layers = 0
 
+        # --- Live progress push (coalesced and rate-limited, see _queue_progress_push) ---
+        self._progress_lock = threading.Lock()
+        self._progress_state = None       # (layer, percent, remaining) waiting to go out
+        self._progress_sent = None
+        self._progress_sent_ts = 0.0
+        self._progress_timer = None
+        self._max_z = None
+        self._layer_offsets = None        # array('Q') of layer start offsets of the selected file
+        self._layer_remaining = None      # array('I') of slicer minutes left at each layer start
+        self._file_size = None
+
+        # --- LCD handshake (print info commands confirmed by 'ok', screen by 'lcd-rendered') ---
+        self.lcd_ready_event = threading.Event()
+        self._lcd_cmd_ok = threading.Event()
+        self._lcd_cmd_written = False
+
         self.print_finish = False
         self.sent_imagemap = False
 
@@ -55,10 +102,33 @@ class LCD_E3V3SEPlugin(
         self.txLine = None
         self.nextLineAck = False
 
+        # --- Windowed thumbnail sender (chunk lines confirmed by ACK LINE / CHUNK / ok) ---
+        self._tx_cond = threading.Condition()
+        self._tx_active = False
+        self._tx_seq = 0                  # bumped per transfer and on abort, a stale sender stops
+        self._tx_acked = 0
+        self._tx_ack_mode = "ok"
+        self._tx_row_ends = []
+        self._tx_position = None
+        self._tx_resends = 0
+        self._tx_inflight = 0
+        self._tx_written = -1
+        self._tx_ok_pending = 0           # chunk lines written whose 'ok' is still due (ok mode)
+
+        # --- Firmware thumbnail capabilities (from 'M9001 CAPS', reset on disconnect) ---
+        self.thumb_caps = {}
+
+        # --- Firmware thumbnail cache ('M9001 H <hash>' -> 'M9001 HASH <hash> CACHED|MISS') ---
+        self.thumb_hash = None
+        self._lcd_thumb_hash = None       # image the firmware holds since it was last (re)connected
+        self._thumb_cache_query = None    # hash of a pending query, reply lands in _thumb_cache_reply
+        self._thumb_cache_reply = None
+
         # --- Metadata thread guard (avoid double-start per file) ---
         self._metadata_lock = threading.Lock()
         self._metadata_running = False
         self._metadata_last_file = None
+        self._metadata_thumb_wanted = False   # thumbnail requested for the running file (PrintStarted)
 
         # --- NEW: Robust pause gate (fixes PAUSING->PAUSED race) ---
         # We pause at PrintStarted if we still need to send the thumbnail,
@@ -66,8 +136,11 @@ class LCD_E3V3SEPlugin(
         self.thumb_rendered_event = threading.Event()
         self.pause_gate_active = False
         self.pause_gate_thread = None
-        
-        # Add in __init__ (new state tracking)
+        self.pause_gate_phase = None
+
+        # Printer state from PrinterStateChanged, waited on by the pause gate
+        self._state_cond = threading.Condition()
+        self._state_seq = 0
         self._last_state_id = "UNKNOWN"
         self._last_state_ts = time.time()
 
@@ -75,8 +148,15 @@ class LCD_E3V3SEPlugin(
         self.start_time = None
         self.elapsed_time = None
 
+        # --- Read-only settings copy for hooks and workers (see _refresh_settings_snapshot) ---
+        self._cfg = None
+
         # --- Logger ---
         self._plugin_logger = logging.getLogger("octoprint.plugins.LCD_E3V3SE")
+        self._log_listener = None
+
+        # --- Serial receive hook dispatch (line prefix -> handler) ---
+        self._build_received_dispatch()
 
     # Required by new OctoPrint versions
     def is_template_autoescaped(self):
@@ -94,17 +174,39 @@ class LCD_E3V3SEPlugin(
             os.makedirs(log_base_path, exist_ok=True)
             os.chmod(log_base_path, 0o775)
 
-        log_file_path = os.path.join(log_base_path, "LCD_E3V3SE.log")
-        handler = CleaningTimedRotatingFileHandler(log_file_path, when="D", backupCount=3)
-        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
-
         # Avoid adding handlers multiple times on reload
-        if not any(isinstance(h, CleaningTimedRotatingFileHandler) for h in self._plugin_logger.handlers):
-            self._plugin_logger.addHandler(handler)
+        if not any(isinstance(h, logging.handlers.QueueHandler) for h in self._plugin_logger.handlers):
+            log_file_path = os.path.join(log_base_path, "LCD_E3V3SE.log")
+            handler = CleaningTimedRotatingFileHandler(log_file_path, when="D", backupCount=3)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+
+            # The serial hooks only put records on a queue, a listener thread does the file I/O.
+            # Chatty categories (M73, events) are thinned out before they are queued.
+            log_queue = queue.Queue()
+            queue_handler = logging.handlers.QueueHandler(log_queue)
+            queue_handler.addFilter(RateLimitFilter())
+            self._log_listener = logging.handlers.QueueListener(log_queue, handler)
+            self._log_listener.start()
+            self._plugin_logger.addHandler(queue_handler)
 
         self._plugin_logger.setLevel(logging.INFO)
         self._plugin_logger.propagate = False
 
+    def on_shutdown(self):
+        self.stop_indexer()
+        if self._metadata_gc_timer is not None:
+            self._metadata_gc_timer.cancel()
+        if self.metadata_store is not None:
+            self.metadata_store.close()
+
+        # Flush whatever is still queued for the log file
+        if self._log_listener is not None:
+            self._log_listener.stop()
+            self._log_listener = None
+            for h in list(self._plugin_logger.handlers):
+                if isinstance(h, logging.handlers.QueueHandler):
+                    self._plugin_logger.removeHandler(h)
+
     def get_current_function_name(self):
         return inspect.getframeinfo(inspect.currentframe().f_back).function
 
@@ -113,10 +215,52 @@ class LCD_E3V3SEPlugin(
         # If your UI does not save, you will always see old stored values.
         return dict(
             enable_gcode_preview=True,       # Send and render G-code thumbnail
+            enable_thumb_pretransmit=True,   # Send the thumbnail on file select instead of behind the print-start pause
             progress_type="m73_progress",    # Progress based on M73
-            enable_purge_filament=False      # Show purge popup on pause
+            enable_purge_filament=False,     # Show purge popup on pause
+            enable_compact_thumb=True,       # Use base64/RLE thumbnail chunks if the firmware supports them
+            thumb_window=8,                  # Initial number of unconfirmed thumbnail lines in flight
+            gate_debounce_s=2.0,             # PRINTING must hold this long after the gate resumes
+            progress_push_s=5,               # Min seconds between live layer/progress updates (0 = off)
+            scan_header_kb=1024,             # Upload scan window from the top of the file (0 = whole file)
+            scan_tail_kb=256,                # Tail window checked when the header misses a field
+            metadata_max_entries=2000,       # Metadata kept for this many most recently modified files
+            metadata_max_age_days=180,       # No metadata kept for files not modified for this long (0 = keep)
+            index_workers=1,                 # Background threads building metadata for files without it
+            enable_eta_correction=True       # Scale slicer time estimates by what past prints actually took
         )
 
+    def initialize(self):
+        self._refresh_settings_snapshot()
+
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._refresh_settings_snapshot()
+        return diff
+
+    def _refresh_settings_snapshot(self):
+        """
+        Rebuild the immutable settings copy in self._cfg. The comm-thread hooks run
+        for every line, they read plain attributes from it instead of walking the
+        settings tree under its lock. Replaced as a whole on every save.
+        """
+        values = {}
+        for key, default in self.get_settings_defaults().items():
+            if isinstance(default, bool):
+                values[key] = self._settings.get_boolean([key])
+            elif isinstance(default, int):
+                values[key] = self._settings.get_int([key])
+            elif isinstance(default, float):
+                values[key] = self._settings.get_float([key])
+            else:
+                values[key] = self._settings.get([key])
+
+        # OctoPrint's own serial setting, refreshed on SettingsUpdated
+        values["always_send_checksum"] = self._settings.global_get_boolean(["serial", "alwaysSendChecksum"])
+
+        snapshot_type = collections.namedtuple("SettingsSnapshot", values)
+        self._cfg = snapshot_type(**values)
+
     def get_template_configs(self):
         # If you use the default settingsViewModel bindings:
         # custom_bindings must be False.
@@ -143,6 +287,18 @@ class LCD_E3V3SEPlugin(
         os.chmod(self.metadata_dir, 0o775)
 
         self._plugin_logger.info(f">>>>>> LCD_E3V3SE Plugin Metadata directory initialized: {self.metadata_dir}")
+
+        # Indexed metadata store (full path + content fingerprint), the JSON files are only read as fallback
+        db_path = os.path.join(data_folder, "metadata.db")
+        self.metadata_store = MetadataStore(db_path)
+        self._plugin_logger.info(f">>>>>> LCD_E3V3SE Plugin Metadata store initialized: {db_path} ({len(self.metadata_store)} entries)")
+        self._metadata_gc_timer = RepeatedTimer(6 * 3600, self.compact_metadata, run_first=True, daemon=True)
+        self._metadata_gc_timer.start()
+
+        # Finished prints, for the ETA correction factor
+        self.print_history = PrintHistory(os.path.join(data_folder, "print_history.jsonl"))
+        self._plugin_logger.info(f">>>>>> LCD_E3V3SE Plugin Print history loaded: {self.print_history.load()} prints")
+        self.start_indexer()
         self.slicer_values()
 
     def slicer_values(self):
@@ -150,24 +306,126 @@ class LCD_E3V3SEPlugin(
         self._plugin_logger.info("Sliders values:")
         self._plugin_logger.info(f"Progress based on: {self._settings.get(['progress_type'])}")
         self._plugin_logger.info(f"Send Gcode Preview: {self._settings.get(['enable_gcode_preview'])}")
+        self._plugin_logger.info(f"Pre-transmit Thumbnail: {self._settings.get(['enable_thumb_pretransmit'])}")
         self._plugin_logger.info(f"Enable Purge Filament: {self._settings.get(['enable_purge_filament'])}")
+        self._plugin_logger.info(f"Compact Thumbnail Encoding: {self._settings.get(['enable_compact_thumb'])}")
+        self._plugin_logger.info(f"Pause gate debounce (s): {self._settings.get(['gate_debounce_s'])}")
+        self._plugin_logger.info(f"Live progress interval (s): {self._settings.get(['progress_push_s'])}")
+        self._plugin_logger.info(f"Upload scan window (KB): header={self._settings.get(['scan_header_kb'])} tail={self._settings.get(['scan_tail_kb'])}")
+        self._plugin_logger.info(f"ETA correction from print history: {self._settings.get(['enable_eta_correction'])}")
 
     # -----------------------
-    # Metadata JSON Helpers
+    # Metadata Helpers
     # -----------------------
-    def save_metadata_to_json(self, filename, metadata):
-        metadata_path = os.path.join(self.metadata_dir, f"{filename}.json")
+    def load_metadata(self, path):
+        """Metadata for the file at storage path, from the store or a legacy JSON file."""
+        # Selected (or printing) right after the upload: wait for its analysis
+        self.wait_analysis(path)
+
+        mtime = self._file_mtime(path)
         try:
-            with open(metadata_path, "w") as f:
-                json.dump(metadata, f)
-            self._plugin_logger.info(f"Metadata saved to {metadata_path}")
+            metadata = self.metadata_store.get(path, mtime)
         except Exception as e:
-            self._plugin_logger.error(
-                f"{self.get_current_function_name()}: Failed to save metadata to {metadata_path}: {e}"
+            self._plugin_logger.error(f"{self.get_current_function_name()}: Metadata store lookup failed for {path}: {e}")
+            metadata = None
+
+        if metadata is not None:
+            self._plugin_logger.info(f"Metadata loaded for {path}")
+            return metadata
+
+        # Uploaded with an older plugin version: one JSON per bare file name
+        legacy_path = os.path.join(self.metadata_dir, f"{os.path.basename(path)}.json")
+        if os.path.exists(legacy_path) and not self.metadata_store.contains(path):
+            metadata = self.load_metadata_from_json(os.path.basename(path))
+            if metadata is not None and metadata.get("file_path") != path:
+                # Same file name in another folder, not this file's metadata
+                self._plugin_logger.info(f"Legacy metadata {legacy_path} belongs to {metadata.get('file_path')}, not {path}")
+                metadata = None
+            elif metadata is not None:
+                try:
+                    self.metadata_store.put(path, metadata, None, mtime)
+                except Exception as e:
+                    self._plugin_logger.warning(f"{self.get_current_function_name()}: Could not migrate {legacy_path}: {e}")
+                return metadata
+
+        # Not indexed yet (or changed on disk), build it now
+        try:
+            return self.index_file(path)
+        except Exception as e:
+            self._plugin_logger.error(f"{self.get_current_function_name()}: No metadata for {path}: {e}")
+
+        self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
+        my_err = f"Error Ocurred! \n \n No metadata found for {path}.\n Try uploading the file again"
+        self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": my_err})
+        return None
+
+    def on_file_event(self, event, payload):
+        """Keep the metadata store in step with OctoPrint's local file storage."""
+        if event in ("FileRemoved", "FolderRemoved"):
+            if payload.get("storage") != "local":
+                return
+            if event == "FileRemoved":
+                self.metadata_store.delete(payload.get("path"))
+                self._plugin_logger.info(f"Metadata removed for {payload.get('path')}")
+            else:
+                removed = self.metadata_store.delete_folder(payload.get("path"))
+                self._plugin_logger.info(f"Metadata removed for folder {payload.get('path')} ({removed} entries)")
+
+        elif event in ("FileMoved", "FolderMoved"):
+            source, destination = payload.get("source_path"), payload.get("destination_path")
+            if payload.get("source_storage") != "local":
+                return
+            if payload.get("destination_storage") != "local":
+                # Moved off local storage, nothing to print from here anymore
+                if event == "FileMoved":
+                    self.metadata_store.delete(source)
+                else:
+                    self.metadata_store.delete_folder(source)
+                return
+            if event == "FileMoved":
+                self.metadata_store.move(source, destination)
+                self._plugin_logger.info(f"Metadata moved {source} -> {destination}")
+            else:
+                moved = self.metadata_store.move_folder(source, destination)
+                self._plugin_logger.info(f"Metadata moved folder {source} -> {destination} ({moved} entries)")
+
+    def _metadata_limits(self):
+        """(max_entries, max_age_s) of the metadata store, None where unlimited."""
+        max_age_days = self._cfg.metadata_max_age_days or 0
+        max_age_s = max_age_days * 86400 if max_age_days > 0 else None
+        return self._cfg.metadata_max_entries or None, max_age_s
+
+    def compact_metadata(self):
+        """
+        Periodic GC: drop entries of deleted files and cap the store by file count
+        and age. The backfill indexer applies the same limits, files outside them
+        are only analysed when selected.
+        """
+        try:
+            max_entries, max_age_s = self._metadata_limits()
+            removed = self.metadata_store.compact(
+                max_entries=max_entries,
+                max_age_s=max_age_s,
+                exists=lambda path: self._file_manager.file_exists("local", path),
             )
-            self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
-            my_err = f"Error Ocurred! \n \n {e}.\n Try uploading the file again"
-            self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": my_err})
+
+            # Legacy JSON files are only read for migration, age them out the same way
+            if max_age_s and self.metadata_dir and os.path.isdir(self.metadata_dir):
+                cutoff = time.time() - max_age_s
+                for entry in os.scandir(self.metadata_dir):
+                    if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+
+            self._plugin_logger.info(f"Metadata GC: {removed} entries removed, {len(self.metadata_store)} kept")
+        except Exception as e:
+            self._plugin_logger.error(f"{self.get_current_function_name()}: {e}")
+
+    def _file_mtime(self, path):
+        """mtime of a file in local storage, None if it can't be determined."""
+        try:
+            return os.path.getmtime(self._file_manager.path_on_disk("local", path))
+        except Exception:
             return None
 
     def load_metadata_from_json(self, filename):
@@ -190,184 +448,422 @@ class LCD_E3V3SEPlugin(
     # Upload preprocessor
     # -----------------------
     def file_preprocessor(self, path, file_object, links, printer_profile, allow_overwrite, *args, **kwargs):
-        """Intercept file uploads and generate a metadata JSON for fast printing."""
+        """Register an analysis job for uploaded G-code, it runs once the file is stored (FileAdded)."""
         self._plugin_logger.info(f">>>>>> PreProcessing file: {file_object}")
         self._plugin_logger.info(f">>>>>> PreProcessing path: {path}")
 
         if not octoprint.filemanager.valid_file_type(path, type="gcode"):
             return file_object
 
-        file_name = file_object.filename
+        # Only register the job here, the upload response must not wait for the scan.
+        # The analysis runs on the saved file once FileAdded arrives.
+        # A job already running belongs to the file being replaced, the new one
+        # needs its own (the old job only drops its entry if it is still current)
+        with self._index_lock:
+            job = self._analysis_jobs.get(path)
+            if job is None or job.running() or job.done():
+                self._analysis_jobs[path] = concurrent.futures.Future()
 
-        # Read the file content from the upload stream
-        file_stream = file_object.stream()
-        file_content = file_stream.read().decode("utf-8", errors="ignore")
+        # Whatever was stored for an older file at this path is stale now
+        self.metadata_store.delete(path)
 
-        total_layers = self.find_total_layers_from_content(file_content)
-        b64_thumb = self.extract_thumbnail_from_content(file_content)
-        progress, self.myETA = self.find_first_m73_from_content(file_content)
-        print_time = self.myETA
+        self._plugin_logger.info(f">>>>>> PreProcessing queued analysis for {file_object.filename}")
+        return file_object
+
+    def analyze_gcode(self, path, file_name, disk_path):
+        """Scan a stored G-code file and build its metadata. Returns (metadata, fingerprint)."""
+        # The file is memory-mapped and searched for the markers. Only the header window
+        # is touched unless a field is missing there, then the tail of the file is checked.
+        header_bytes = max(self._cfg.scan_header_kb or 0, 0) * 1024
+        tail_bytes = max(self._cfg.scan_tail_kb or 0, 0) * 1024
+        scanner = scan_file(disk_path, header_bytes, tail_bytes)
+        self._plugin_logger.info(f">>>>>> Scanned {scanner.bytes_read} bytes of {path} (eof={scanner.eof})")
+
+        # Same content analysed before (copy, identical re-upload, only the mtime changed)
+        metadata = self.metadata_for_fingerprint(scanner.fingerprint, path, file_name)
+        if metadata is not None:
+            return metadata, scanner.fingerprint
+
+        b64_thumb = scanner.thumbnail
+        if b64_thumb:
+            self._plugin_logger.info(f"Extracted thumbnail, size: {len(b64_thumb)} characters")
+        else:
+            self._plugin_logger.warning("No valid thumbnail found in GCODE")
+
+        # Pre-render the firmware-ready RGB565 payload once, so selecting the file
+        # only has to stream bytes to the printer
+        thumb_rgb565 = self.render_thumb_payload(b64_thumb, "M9001")
+        thumb_hash = payload_hash(base64.b64decode(thumb_rgb565)) if thumb_rgb565 else None
+
+        # Byte offset of every layer change, so the layer being printed can be looked
+        # up from the file position instead of guessed from Z moves, and the slicer's
+        # M73 R time at each of them for the remaining time estimate. Unlike the
+        # header scan above this reads the whole file once.
+        offsets, remaining, profile = scan_layer_index(disk_path)
+        self._plugin_logger.info(
+            f">>>>>> Indexed {len(offsets)} layer changes of {path} (time table: {len(remaining) > 0})"
+        )
 
         metadata = {
             "file_name": file_name,
             "file_path": path,
-            "total_layers": total_layers,
-            "print_time": print_time,
+            "total_layers": scanner.total_layers or len(offsets),
+            "print_time": scanner.remaining,
+            "slicer": scanner.slicer_type,
+            "profile": profile,
             "current_layer": 0,
-            "progress": progress,
+            "progress": scanner.progress,
             "thumb_data": b64_thumb,
+            "thumb_rgb565": thumb_rgb565,
+            "thumb_hash": thumb_hash,
+            "layer_offsets": encode_offsets(offsets),
+            "layer_remaining": encode_offsets(remaining, "I"),
+            "file_size": scanner.size,
             "processed": True
         }
+        return metadata, scanner.fingerprint
+
+    def metadata_for_fingerprint(self, fingerprint, path, file_name):
+        """Copy of the stored metadata of another file with the same content fingerprint, or None."""
+        candidates = self.metadata_store.find_by_fingerprint(fingerprint)
+        # The file's own older entry first
+        candidates.sort(key=lambda candidate: candidate != path)
+        for candidate in candidates:
+            metadata = self.metadata_store.get(candidate)
+            # Entries from before the layer index are rebuilt instead
+            if metadata is None or "layer_offsets" not in metadata:
+                continue
+            self._plugin_logger.info(f">>>>>> {path} has the same content as {candidate}, reusing its metadata")
+            return dict(metadata, file_path=path, file_name=file_name)
+        return None
+
+    # -----------------------
+    # Backfill indexer
+    # -----------------------
+    def start_indexer(self):
+        """
+        Queue every local G-code file that has no (current) metadata yet, newest
+        first and within the store limits, so the GC doesn't drop what was built.
+        """
+        if self._index_pool is None:
+            workers = max(self._cfg.index_workers or 1, 1)
+            self._index_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="LCD_E3V3SE-index", initializer=self._lower_thread_priority
+            )
+
+        def _walk():
+            try:
+                max_entries, max_age_s = self._metadata_limits()
+                cutoff = time.time() - max_age_s if max_age_s else None
+                files = sorted(((self._file_mtime(path) or 0, path) for path in self._local_gcode_files()), reverse=True)
+
+                queued = 0
+                for rank, (mtime, path) in enumerate(files):
+                    if (max_entries and rank >= max_entries) or (cutoff and mtime < cutoff):
+                        break
+                    queued += self.queue_index(path)
+                self._plugin_logger.info(f"Indexer: {queued} of {len(files)} files queued for metadata backfill")
+            except Exception as e:
+                self._plugin_logger.error(f"Indexer: storage walk failed: {e}")
+
+        self._index_pool.submit(_walk)
 
-        self._plugin_logger.info(f">>>>>> PreProcessing metadata: {metadata}")
+    def stop_indexer(self):
+        if self._index_pool is not None:
+            self._index_pool.shutdown(wait=False)
+            self._index_pool = None
+        if self._analysis_pool is not None:
+            self._analysis_pool.shutdown(wait=False)
+            self._analysis_pool = None
 
+    # -----------------------
+    # Upload analysis jobs
+    # -----------------------
+    def start_analysis(self, path):
+        """
+        Run the analysis registered by the preprocessor for path. False if there is
+        none, True if it is started now or already running (wait_analysis got there
+        before FileAdded).
+        """
+        with self._index_lock:
+            job = self._analysis_jobs.get(path)
+            if job is None or job.done():
+                return False
+            if job.running():
+                return True
+            if not job.set_running_or_notify_cancel():
+                return False
+            if self._analysis_pool is None:
+                self._analysis_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=2, thread_name_prefix="LCD_E3V3SE-analysis"
+                )
+        self._analysis_pool.submit(self._analysis_job, path, job)
+        return True
+
+    def _analysis_job(self, path, job):
         try:
-            self.save_metadata_to_json(file_name, metadata)
-            self._plugin_logger.info(f"Metadata written for {path}")
+            metadata = self.index_file(path, force=True)
         except Exception as e:
-            self._plugin_logger.error(f"{self.get_current_function_name()}: Error writing metadata for {path}: {e}")
+            self._plugin_logger.error(f"{self.get_current_function_name()}: Error analysing {path}: {e}")
+            job.set_exception(e)
             my_err = f"Error Ocurred! \n \n {e}.\n Try uploading the file again"
-            self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": my_err})
+            self._plugin_manager.send_plugin_message(
+                self._identifier, {"type": "analysis_done", "path": path, "ok": False, "message": my_err}
+            )
+        else:
+            job.set_result(metadata)
+            self._plugin_logger.info(f">>>>>> Analysis complete for {path}: {loggable(metadata)}")
+            self._plugin_manager.send_plugin_message(self._identifier, {"type": "analysis_done", "path": path, "ok": True})
+        finally:
+            with self._index_lock:
+                if self._analysis_jobs.get(path) is job:
+                    del self._analysis_jobs[path]
+
+    def wait_analysis(self, path, timeout_s=120):
+        """Block until a pending upload analysis for path is done. Returns its metadata or None."""
+        with self._index_lock:
+            job = self._analysis_jobs.get(path)
+        if job is None:
+            return None
+        if not job.running() and not job.done():
+            # FileAdded not seen (yet), analyse whatever is on disk now. A newer
+            # file landing later is re-indexed because its mtime differs.
+            self.start_analysis(path)
+        self._plugin_logger.info(f"Waiting for the upload analysis of {path}...")
+        try:
+            return job.result(timeout=timeout_s)
+        except Exception as e:
+            self._plugin_logger.warning(f"Upload analysis of {path} not available: {e!r}")
+            return None
 
-        self._plugin_logger.info(f">>>>>> PreProcessing parsing complete for {file_name}")
-        return file_object
+    def _local_gcode_files(self):
+        """Storage paths ('folder/file.gcode') of all G-code files in local storage."""
+        base = self._file_manager.path_on_disk("local", "")
+        for root, _dirs, files in os.walk(base):
+            for name in files:
+                rel = os.path.relpath(os.path.join(root, name), base).replace(os.sep, "/")
+                if octoprint.filemanager.valid_file_type(rel, type="gcode"):
+                    yield rel
+
+    @staticmethod
+    def _lower_thread_priority():
+        # Indexing must never compete with the serial thread. On Linux a thread id
+        # passed as PRIO_PROCESS only renices that thread.
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+    def queue_index(self, path):
+        """Queue path for indexing unless it is current or already queued. Returns 1 if queued."""
+        if self._index_pool is None or self.metadata_store.contains(path, self._file_mtime(path)):
+            return 0
+        with self._index_lock:
+            if path in self._index_pending:
+                return 0
+            self._index_pending.add(path)
+        self._index_pool.submit(self._index_job, path)
+        return 1
+
+    def _index_job(self, path):
+        try:
+            self.index_file(path)
+        except Exception as e:
+            self._plugin_logger.error(f"Indexer: {path} failed: {e}")
+        finally:
+            with self._index_lock:
+                self._index_pending.discard(path)
+
+    def index_file(self, path, force=False):
+        """Build and store metadata for a file already in local storage. Returns the metadata."""
+        disk_path = self._file_manager.path_on_disk("local", path)
+        mtime = os.path.getmtime(disk_path)
+        if not force and self.metadata_store.contains(path, mtime):
+            return self.metadata_store.get(path, mtime)
+
+        metadata, fingerprint = self.analyze_gcode(path, os.path.basename(path), disk_path)
+        self.metadata_store.put(path, metadata, fingerprint, mtime)
+        self._plugin_logger.info(f"Indexer: metadata built for {path}")
+        return metadata
 
     # -----------------------
     # Thread guards
     # -----------------------
-    def _start_metadata_thread_once(self, file_name, thumb_enabled):
-        """Start metadata processing in a background thread (idempotent per file)."""
-        if not file_name:
+    def _start_metadata_thread_once(self, file_path, thumb_enabled):
+        """
+        Start metadata processing in a background thread (idempotent per file).
+        A thumbnail requested while a run without it is still going (print started
+        right after select) is picked up by that run, or by a second run if it had
+        already passed the point of sending it.
+        """
+        if not file_path:
             return
 
         with self._metadata_lock:
-            if self._metadata_running and self._metadata_last_file == file_name:
+            if self._metadata_running and self._metadata_last_file == file_path:
+                if thumb_enabled:
+                    self._metadata_thumb_wanted = True
                 return
             self._metadata_running = True
-            self._metadata_last_file = file_name
+            self._metadata_last_file = file_path
+            self._metadata_thumb_wanted = thumb_enabled
 
         def _runner():
             try:
-                self.get_print_metadata(file_name, thumb_enabled)
+                self.get_print_metadata(file_path, thumb_enabled)
             finally:
                 with self._metadata_lock:
-                    self._metadata_running = False
+                    # A newer selection owns the guard now, leave it alone
+                    current = self._metadata_last_file == file_path
+                    if current:
+                        self._metadata_running = False
+                    rerun = current and self._metadata_thumb_wanted and not thumb_enabled and not self.sent_imagemap
+                if rerun:
+                    self._start_metadata_thread_once(file_path, True)
 
         threading.Thread(target=_runner, daemon=True).start()
 
+    def _is_selected(self, file_path):
+        """False once another file was selected after a run for file_path started."""
+        return file_path is None or file_path == self.file_path
+
+    def _thumb_requested(self, file_path):
+        with self._metadata_lock:
+            return self._metadata_thumb_wanted and self._metadata_last_file == file_path
+
     # -----------------------
     # Robust pause gate (fix)
     # -----------------------
-    def _start_pause_gate(self, timeout_s=180):
+    def _start_pause_gate(self, timeout_s=180, resume_window_s=30.0, max_resumes=5, min_debounce_s=0.5,
+                          unpaused_debounce_s=2.0):
         """
-        Pause the print and keep retrying resume until thumbnail-rendered arrives.
-        FIX: Do not trust is_printing() during transitions. Wait for stable PRINTING state.
+        Pause the print and resume it once the firmware sends 'thumbnail-rendered'.
+
+        The worker is a small state machine driven by PrinterStateChanged through
+        _state_cond, it never polls and simply blocks while the printer is paused:
+          WAIT_THUMB   pause requested, waiting for 'thumbnail-rendered'
+          WAIT_PAUSED  waiting for OctoPrint to report PAUSED (PAUSING is not enough)
+          RESUMING     resume sent the moment PAUSED was seen, waiting for PRINTING
+          DEBOUNCE     PRINTING seen, done unless the state changes within gate_debounce_s
+        A bounce back to PAUSED restarts at WAIT_PAUSED, up to max_resumes times.
+
+        The debounce never drops below min_debounce_s. While no PAUSED has been seen
+        yet, PRINTING may only mean the pause request has not landed, so it has to
+        hold for at least unpaused_debounce_s.
         """
         if self.pause_gate_thread and self.pause_gate_thread.is_alive():
             return
 
         self.thumb_rendered_event.clear()
         self.pause_gate_active = True
+        debounce_s = max(self._cfg.gate_debounce_s or 0.0, min_debounce_s)
 
-        def _state():
-            # Prefer event-derived state (more accurate than is_printing() during races)
-            return getattr(self, "_last_state_id", "UNKNOWN")
-
-        def _wait_stable_printing(stable_s=2.0, window_s=10.0):
+        def _wait_state(predicate, timeout, since_seq=None):
             """
-            Return True if we observe PRINTING continuously for stable_s seconds.
+            Block until predicate(state) holds (for a state reported after since_seq,
+            if given). Returns the state, or None on timeout or when the gate stops.
             """
-            end_window = time.time() + window_s
-            stable_start = None
-
-            while time.time() < end_window and self.pause_gate_active:
-                s = _state()
-
-                if s == "PRINTING":
-                    if stable_start is None:
-                        stable_start = time.time()
-                    elif (time.time() - stable_start) >= stable_s:
-                        return True
-                else:
-                    stable_start = None
-
-                time.sleep(0.2)
+            def _ready():
+                if not self.pause_gate_active:
+                    return True
+                if since_seq is not None and self._state_seq <= since_seq:
+                    return False
+                return predicate(self._last_state_id)
+
+            with self._state_cond:
+                if self._state_cond.wait_for(_ready, timeout=timeout) and self.pause_gate_active:
+                    return self._last_state_id
+                return None
 
-            return False
+        def _phase(name):
+            self.pause_gate_phase = name
+            self._plugin_logger.info(f"GATE: -> {name} (printer state {self._last_state_id})")
 
         def worker():
             try:
                 self._plugin_logger.info("GATE: Pausing print until firmware sends 'thumbnail-rendered'...")
+                _phase("WAIT_THUMB")
 
                 # Request pause (Printing -> Pausing -> Paused)
                 if self._printer.is_printing():
                     self._printer.pause_print()
 
                 ok = self.thumb_rendered_event.wait(timeout=timeout_s)
+                if not self.pause_gate_active:
+                    return
                 if not ok:
                     self._plugin_logger.warning("GATE: Timeout waiting 'thumbnail-rendered'. Trying to resume anyway.")
                 else:
                     self._plugin_logger.info("GATE: 'thumbnail-rendered' received. Resuming print...")
 
-                # Give OctoPrint a tiny moment to finish the PAUSE state transition
-                time.sleep(0.3)
-
-                # Robust resume loop
-                end_time = time.time() + 30.0  # bigger window for slow state transitions
+                deadline = time.time() + resume_window_s
                 resume_attempts = 0
+                paused_seen = False
+                _phase("WAIT_PAUSED")
 
-                while time.time() < end_time and self.pause_gate_active:
-                    s = _state()
-
-                    # If fully paused, resume
-                    if s == "PAUSED":
-                        try:
-                            self._printer.resume_print()
-                            resume_attempts += 1
-                            self._plugin_logger.info(f"GATE: resume_print() attempt #{resume_attempts}")
-                        except Exception as e:
-                            self._plugin_logger.error(f"GATE: resume_print failed: {e}")
-
-                        # After resume request, wait for stable PRINTING
-                        if _wait_stable_printing(stable_s=2.0, window_s=8.0):
-                            self._plugin_logger.info("GATE: Printer is PRINTING and stable. Gate complete.")
-                            return
-
-                        # If not stable yet, keep looping (OctoPrint might bounce)
-                        time.sleep(0.5)
-                        continue
-
-                    # If pausing, just wait (do not declare success)
-                    if s == "PAUSING":
-                        time.sleep(0.25)
-                        continue
+                while self.pause_gate_active:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
 
-                    # If printing, require stability before declaring success
-                    if s == "PRINTING":
-                        if _wait_stable_printing(stable_s=2.0, window_s=6.0):
+                    if self.pause_gate_phase == "WAIT_PAUSED":
+                        state = _wait_state(lambda s: s in ("PAUSED", "PRINTING"), remaining)
+                        if state == "PAUSED":
+                            paused_seen = True
+                            if resume_attempts >= max_resumes:
+                                break
+                            with self._state_cond:
+                                seq = self._state_seq
+                            try:
+                                self._printer.resume_print()
+                                resume_attempts += 1
+                                self._plugin_logger.info(f"GATE: resume_print() attempt #{resume_attempts}")
+                            except Exception as e:
+                                self._plugin_logger.error(f"GATE: resume_print failed: {e}")
+                            _phase("RESUMING")
+                        elif state == "PRINTING":
+                            # Pause never took hold (or was resumed by someone else)
+                            with self._state_cond:
+                                seq = self._state_seq
+                            _phase("DEBOUNCE")
+
+                    elif self.pause_gate_phase == "RESUMING":
+                        state = _wait_state(lambda s: s in ("PAUSED", "PRINTING"), remaining, since_seq=seq)
+                        if state == "PRINTING":
+                            with self._state_cond:
+                                seq = self._state_seq
+                            _phase("DEBOUNCE")
+                        elif state == "PAUSED":
+                            _phase("WAIT_PAUSED")
+
+                    elif self.pause_gate_phase == "DEBOUNCE":
+                        # Any state change within the debounce window means OctoPrint bounced
+                        window_s = debounce_s if paused_seen else max(debounce_s, unpaused_debounce_s)
+                        state = _wait_state(lambda s: True, min(window_s, remaining), since_seq=seq)
+                        if state is None and self.pause_gate_active:
                             self._plugin_logger.info("GATE: Printer is PRINTING and stable. Gate complete.")
                             return
-                        time.sleep(0.25)
-                        continue
-
-                    # For other states (STARTING/OPERATIONAL/etc), just wait and retry
-                    time.sleep(0.25)
+                        if state is not None:
+                            _phase("WAIT_PAUSED")
 
-                self._plugin_logger.warning("GATE: Resume loop ended. Printer may still be paused.")
+                if self.pause_gate_active:
+                    self._plugin_logger.warning("GATE: Resume loop ended. Printer may still be paused.")
 
             except Exception as e:
                 self._plugin_logger.error(f"GATE: Exception in pause gate worker: {e}")
             finally:
                 self.pause_gate_active = False
+                self.pause_gate_phase = None
 
         self.pause_gate_thread = threading.Thread(target=worker, daemon=True)
         self.pause_gate_thread.start()
 
-
     def _stop_pause_gate(self):
         """Disable gate loops and unblock waiters (used on cancel/done)."""
         self.pause_gate_active = False
         self.thumb_rendered_event.set()
+        with self._state_cond:
+            self._state_cond.notify_all()
 
     # -----------------------
     # Events
@@ -375,33 +871,66 @@ class LCD_E3V3SEPlugin(
     def on_event(self, event, payload):
         # NOTE: Logging full payload is useful for debug but can be noisy.
         if event != "ZChange":
-            self._plugin_logger.info(f">>>>>> Event received: {event}")
+            self._plugin_logger.info(f">>>>>> Event received: {event}", extra={"category": "event"})
 
         if event == "PrinterStateChanged":
             state = payload.get("state_id", "UNKNOWN")
-            self._last_state_id = state
-            self._last_state_ts = time.time()
-            
+            with self._state_cond:
+                self._last_state_id = state
+                self._last_state_ts = time.time()
+                self._state_seq += 1
+                self._state_cond.notify_all()
+
             self._plugin_logger.info(f">>>>>> ++++ Intercepted state: {state}")
 
             if state == "STARTING":
                 self._plugin_logger.info(">>> Print Job is starting.")
 
             if state == "PAUSED":
-                if ( self._settings.get(["enable_purge_filament"]) and not self.pause_gate_active):
+                if (self._cfg.enable_purge_filament and not self.pause_gate_active):
                     self._plugin_logger.info(">>> Printer is paused. Opening Purge popup.")
                     self._plugin_manager.send_plugin_message(
                         self._identifier,
                         {"type": "purge_popup", "message": "Printer is paused. Do you want to purge filament?"}
                     )
 
+        if event == "FileAdded":
+            if payload.get("storage") == "local" and "gcode" in (payload.get("type") or []):
+                if not self.start_analysis(payload.get("path")):
+                    self.queue_index(payload.get("path"))
+            return
+
+        if event in ("FileRemoved", "FileMoved", "FolderRemoved", "FolderMoved"):
+            self.on_file_event(event, payload)
+            return
+
+        if event == "SettingsUpdated":
+            # Also covers OctoPrint's own settings, e.g. serial.alwaysSendChecksum
+            self._refresh_settings_snapshot()
+
         if event == "Connected":
             self.send_M9000_cmd("A1")
+            # Ask the firmware which thumbnail encodings it understands
+            self.thumb_caps = {}
+            self._lcd_thumb_hash = None
+            self.send_M9001_cmd("M9001 Q")
+
+        if event == "Disconnected":
+            self.thumb_caps = {}
+            self._lcd_thumb_hash = None
+            # Wake a pending handshake, it checks is_operational() and gives up
+            self._lcd_cmd_ok.set()
+            self.lcd_ready_event.set()
 
         if event == "FileSelected":
             self.file_name = payload.get("name")
             self.file_path = payload.get("path")
 
+            # A transfer for the previously selected file must not finish on top of this one
+            self._abort_thumb_tx()
+            # The layer index belongs to the previous file until the metadata is loaded
+            self._reset_layer_index()
+
             # If the file comes from SD card, we don't handle metadata (as you wanted)
             if payload.get("origin") == "sdcard":
                 self._plugin_logger.info("File selected from SD Card, not processing metadata.")
@@ -410,35 +939,52 @@ class LCD_E3V3SEPlugin(
             # Reset flags for a fresh render
             self.sent_imagemap = False
             self.is_lcd_ready = False
+            self.lcd_ready_event.clear()
 
             try:
-                if self._settings.get(["enable_gcode_preview"]):
+                if self._cfg.enable_gcode_preview and not self._cfg.enable_thumb_pretransmit:
+                    # Thumbnail goes out behind the pause gate once the print starts
+                    self._plugin_logger.info("FileSelected: Thumbnail deferred to print start.")
+                    self._start_metadata_thread_once(self.file_path, False)
+
+                elif self._cfg.enable_gcode_preview:
                     self._plugin_logger.info("FileSelected: Will render G-code thumbnail.")
                     self._plugin_manager.send_plugin_message(
                         self._identifier,
                         {"type": "popup", "message": "Rendering Data in the LCD. Please Wait..."}
                     )
-                    self._start_metadata_thread_once(self.file_name, True)
+                    self._start_metadata_thread_once(self.file_path, True)
                 else:
                     self._plugin_logger.info("FileSelected: Thumbnail disabled, using default thumbnail.")
+                    self._lcd_thumb_hash = None
                     self.send_M9000_cmd("S0")
-                    self._start_metadata_thread_once(self.file_name, False)
+                    self._start_metadata_thread_once(self.file_path, False)
 
             except Exception as e:
                 self._plugin_logger.error(f"{self.get_current_function_name()}: {e}")
                 my_err = f"Error Ocurred! \n \n {e}.\n Try uploading the file again"
                 self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": my_err})
 
+        if event == "ZChange":
+            self.on_z_change(payload.get("new"))
+            return
+
         if event == "PrintStarted":
             self.slicer_values()
             self._plugin_logger.info(">>>+++ PrintStarted <<<")
             self.start_time = time.time()
+            self.current_layer = 0
+            self._max_z = None
+            self._progress_sent = None
 
             # If direct print races FileSelected, ensure metadata thread is started
-            # and gate the print until we confirm thumbnail rendered.
-            if self._settings.get(["enable_gcode_preview"]) and self.file_name and not self.sent_imagemap:
+            # and gate the print until we confirm thumbnail rendered. A thumbnail
+            # pre-transmitted while idle needs no pause at all.
+            if self._cfg.enable_gcode_preview and self.file_path and not self.sent_imagemap:
                 self._start_pause_gate(timeout_s=180)
-                self._start_metadata_thread_once(self.file_name, True)
+                self._start_metadata_thread_once(self.file_path, True)
+            elif self.sent_imagemap:
+                self._plugin_logger.info("PrintStarted: Thumbnail already transmitted, no pause needed.")
 
         if event == "PrintCancelled":
             # Stop gates first to avoid leaving printer paused
@@ -450,6 +996,7 @@ class LCD_E3V3SEPlugin(
             self._stop_pause_gate()
 
             e_time = self.get_elapsed_time()
+            self.record_print_history(payload.get("time"))
             self.send_M9000_cmd(f"T{e_time} L{self.total_layers} P100")
             self.send_M9000_cmd("F1")
 
@@ -460,60 +1007,75 @@ class LCD_E3V3SEPlugin(
     # -----------------------
     # Metadata sender
     # -----------------------
-    def get_print_metadata(self, file_name, thumb_enabled):
-        """Load metadata JSON and send print info + thumbnail to the firmware."""
+    def get_print_metadata(self, file_path, thumb_enabled):
+        """Load the file's metadata from the store and send print info + thumbnail to the firmware."""
         try:
-            self._plugin_logger.info(f">>>>>> Called get_print_metadata for {file_name}")
+            self._plugin_logger.info(f">>>>>> Called get_print_metadata for {file_path}")
 
             # Always reset this so we don't skip waiting due to stale state
             self.is_lcd_ready = False
+            self.lcd_ready_event.clear()
 
-            md = self.load_metadata_from_json(file_name)
+            md = self.load_metadata(file_path)
             if md is None:
-                self._plugin_logger.error("get_print_metadata: metadata JSON not found/invalid.")
+                self._plugin_logger.error("get_print_metadata: metadata not found/invalid.")
+                return None
+
+            # Another file was selected while this one was loading
+            if not self._is_selected(file_path):
+                self._plugin_logger.info(f"get_print_metadata: {file_path} is no longer selected, skipped.")
                 return None
 
-            self.file_name = md.get("file_name")
-            self.file_path = md.get("file_path")
+            # The stored path/name are those of the upload, the file may have been moved since
+            self.file_name = os.path.basename(file_path) or md.get("file_name")
             self.total_layers = md.get("total_layers")
             self.print_time = md.get("print_time")
+            self.slicer = md.get("slicer")
+            self.print_profile = md.get("profile")
+            self._eta_factor = self._history_correction()
             self.current_layer = md.get("current_layer", 0)
             self.progress = md.get("progress", 0)
             self.b64_thumb = md.get("thumb_data")
+            self.thumb_rgb565 = md.get("thumb_rgb565")
+            self.thumb_hash = md.get("thumb_hash")
+            # Metadata written before the index existed has none, ZChange counting is used then
+            self._layer_offsets = decode_offsets(md.get("layer_offsets")) or None
+            self._layer_remaining = decode_offsets(md.get("layer_remaining"), "I") or None
+            self._file_size = md.get("file_size")
 
             self._plugin_logger.info("Sending Print Info (M9000)")
             self._plugin_logger.info(f"File Name: {self.file_name}")
             self._plugin_logger.info(f"Total Layers: {self.total_layers}")
-            self._plugin_logger.info(f"Print Time (min): {self.print_time}")
+            self._plugin_logger.info(f"Print Time (min): {self.print_time} (history correction x{self._eta_factor:.2f})")
             self._plugin_logger.info(f"Progress (%): {self.progress}")
 
-            # Send the print info using custom command M9000    
-            self.send_M9000_cmd(f'N"{self.file_name}"')
-            time.sleep(0.3)
-            self.send_M9000_cmd(f"T{self.print_time} L{self.total_layers} P{self.progress}")
-            time.sleep(0.3)
-            self._printer.commands(f"M73 R{self.print_time}")  
-            time.sleep(0.3)
-            self.send_M9000_cmd("S1")  # start rendering screen
-
-            # Wait for LCD-ready signal from firmware
-            t0 = time.time()
-            while not self.is_lcd_ready:
-                # Avoid infinite loop if printer disconnects
-                if not self._printer.is_operational():
-                    self._plugin_logger.warning("LCD wait aborted: printer not operational.")
+            # Send the print info using custom command M9000, each step waits for the firmware's 'ok'.
+            # M73 carries the raw slicer minutes, the queuing hook applies the correction to it.
+            handshake = (
+                f'M9000 N"{self.file_name}"',
+                f"M9000 T{self.corrected_minutes(self.print_time)} L{self.total_layers} P{self.progress}",
+                f"M73 R{self.print_time}",
+            )
+            for cmd in handshake:
+                if not self._send_handshake_cmd(cmd):
                     return None
-                if time.time() - t0 > 30.0:
-                    self._plugin_logger.warning("LCD wait timeout (30s). Continuing anyway.")
-                    break
-                time.sleep(0.2)
+
+            # Start rendering screen, the firmware answers 'lcd-rendered' when done
+            if not self._send_handshake_cmd("M9000 S1") or not self._wait_lcd_ready():
+                return None
+
+            if not self._is_selected(file_path):
+                self._plugin_logger.info(f"get_print_metadata: {file_path} is no longer selected, thumbnail skipped.")
+                return None
 
             self._plugin_logger.info("LCD print info rendered. Sending thumbnail...")
-            time.sleep(0.15)
 
-            if self._settings.get(["enable_gcode_preview"]) and thumb_enabled:
+            if self._cfg.enable_gcode_preview and (thumb_enabled or self._thumb_requested(file_path)):
                 if not self.sent_imagemap:
-                    self.send_thumb_imagemap(self.b64_thumb, "M9001")
+                    self.send_thumb_imagemap(self.b64_thumb, "M9001", self.thumb_rgb565, self.thumb_hash, file_path)
+            elif self._cfg.enable_gcode_preview:
+                # Deferred: the thumbnail follows behind the pause gate at print start
+                self._plugin_logger.info("Thumbnail deferred to print start.")
             else:
                 self._plugin_logger.info("Thumbnail disabled or skipped.")
                 self.send_M9000_cmd("D1")
@@ -526,6 +1088,125 @@ class LCD_E3V3SEPlugin(
             self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": my_err})
             return False
 
+    # -----------------------
+    # Live progress
+    # -----------------------
+    def on_print_progress(self, storage, path, progress):
+        # SD prints have no local metadata to report against
+        if storage != "local":
+            return
+        self.progress = progress
+        layer = self._layer_from_filepos()
+        if layer is not None:
+            self.current_layer = layer
+        self._queue_progress_push()
+
+    def _current_filepos(self):
+        return (self._printer.get_current_data().get("progress") or {}).get("filepos")
+
+    def _layer_from_filepos(self):
+        """Layer at the current file position from the offset index, or None without one."""
+        if not self._layer_offsets:
+            return None
+        filepos = self._current_filepos()
+        if filepos is None:
+            return None
+        return layer_at(self._layer_offsets, filepos)
+
+    def _remaining_from_filepos(self):
+        """
+        Slicer minutes left at the current file position from the per-layer time
+        table. Unlike the last M73 seen on the wire this also holds for jobs
+        resumed or restarted mid-file. None without a table.
+        """
+        if not self._layer_remaining or not self._layer_offsets:
+            return None
+        filepos = self._current_filepos()
+        if filepos is None:
+            return None
+        return remaining_at(self._layer_offsets, self._layer_remaining, filepos, self._file_size)
+
+    def _reset_layer_index(self):
+        self._layer_offsets = None
+        self._layer_remaining = None
+        self._file_size = None
+
+    def on_z_change(self, new_z):
+        """
+        Update the layer on ZChange. With a layer index the file position decides,
+        otherwise every new highest Z counts as a layer (z-hops may overcount).
+        """
+        if new_z is None or not self._printer.is_printing():
+            return
+        layer = self._layer_from_filepos()
+        if layer is not None:
+            if layer != self.current_layer:
+                self.current_layer = layer
+                self._queue_progress_push()
+            return
+        if self._max_z is None or new_z > self._max_z + 1e-6:
+            self._max_z = new_z
+            self.current_layer += 1
+            self._queue_progress_push()
+
+    def _queue_progress_push(self):
+        """
+        Coalesce live layer/percent/remaining updates for the LCD. Only the newest
+        state is kept; it goes out when it differs from what was sent last and
+        progress_push_s have passed since, otherwise a single timer sends it later.
+        Nothing is pushed without metadata for the job (reprint after cleanup, SD).
+        """
+        interval = self._cfg.progress_push_s or 0
+        if interval <= 0 or self.print_time is None or not self._printer.is_printing():
+            return
+
+        remaining = self._remaining_from_filepos()
+        if remaining is None:
+            remaining = self.myETA if self.myETA is not None else self.print_time
+        with self._progress_lock:
+            self._progress_state = (self.current_layer, int(self.progress or 0), remaining)
+            if self._progress_timer is not None:
+                return
+            wait = self._progress_sent_ts + interval - time.time()
+            if wait > 0:
+                self._schedule_progress_flush(wait)
+                return
+        self._flush_progress()
+
+    def _schedule_progress_flush(self, wait):
+        # Called with _progress_lock held
+        self._progress_timer = threading.Timer(wait, self._flush_progress)
+        self._progress_timer.daemon = True
+        self._progress_timer.start()
+
+    def _flush_progress(self, retry_s=1.0):
+        with self._progress_lock:
+            self._progress_timer = None
+            state = self._progress_state
+            if state is None or state == self._progress_sent or not self._printer.is_printing():
+                return
+            print_time = self.print_time
+            if print_time is None:
+                # Cleaned up since the state was queued
+                return
+
+            # Lowest priority: never between thumbnail lines, during the pause gate
+            # or while the firmware reports busy
+            if self._tx_active or self.pause_gate_active or self.printer_busy:
+                self._schedule_progress_flush(retry_s)
+                return
+
+            self._progress_sent = state
+            self._progress_sent_ts = time.time()
+
+        layer, percent, remaining = state
+        if remaining is None:
+            remaining = print_time
+        self.send_M9000_cmd(
+            f"T{self.corrected_minutes(print_time)} L{self.total_layers} P{percent} "
+            f"C{layer} R{self.corrected_minutes(remaining)}"
+        )
+
     # -----------------------
     # G-code hooks
     # -----------------------
@@ -537,6 +1218,15 @@ class LCD_E3V3SEPlugin(
         """
         tags = tags or kwargs.get("tags") or set()
 
+        # Last look at our thumbnail lines before they hit the serial line
+        if phase == "sending":
+            if "lcd_thumb" in tags:
+                return self._on_thumb_line_sending(tags)
+            if "lcd_handshake" in tags:
+                # The next 'ok' belongs to this command
+                self._lcd_cmd_written = True
+            return None
+
         if phase != "queuing":
             return None
 
@@ -548,72 +1238,131 @@ class LCD_E3V3SEPlugin(
         if gcode == "M105":
             return None
 
-        # Optional: log M73 commands
-        if cmd.startswith("M73") and self._settings.get(["progress_type"]) == "m73_progress":
-            self._plugin_logger.info(f"=================>> GOT M73 command: {cmd}")
+        if cmd.startswith("M73"):
+            # Remember the slicer's remaining time for the live progress push,
+            # always the raw minutes, the push corrects them itself
+            params = cmd.split()
+            for i, param in enumerate(params[1:], 1):
+                if param[:1] == "R" and param[1:].isdigit():
+                    self.myETA = int(param[1:])
+                    # The printer shows this too, give it the corrected estimate
+                    if self._eta_factor != 1.0:
+                        params[i] = f"R{self.corrected_minutes(self.myETA)}"
+                        cmd = " ".join(params)
+
+            # Optional: log M73 commands
+            if self._cfg.progress_type == "m73_progress":
+                self._plugin_logger.info(f"=================>> GOT M73 command: {cmd}", extra={"category": "m73"})
+
+            if self._eta_factor != 1.0:
+                return cmd
 
         return None
 
     def gcode_received_handler(self, comm, line, *args, **kwargs):
-        # Firmware tells us LCD is ready
-        if line.startswith("M9000"):
-            if "lcd-rendered" in line:
-                self.is_lcd_ready = True
-                return line
+        """
+        Runs for every line the printer sends. Only lines starting with one of the
+        prefixes in _received_dispatch matter to us, everything else (temperature
+        reports, echo chatter) is passed through after a single dict lookup.
+        """
+        handler = self._received_dispatch.get(line[:2])
+        if handler is not None:
+            handler(line)
+        return line
 
-            if "pause-job" in line:
-                if self._printer.is_printing():
-                    self._printer.pause_print()
-                return line
-
-            if "resume-job" in line:
-                if self._printer.is_paused():
-                    self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_purge_popup"))
-                    self._printer.resume_print()
-                return line
-            
-            if "cancel-job" in line:
-                if self._printer.is_printing() or self._printer.is_paused():
-                    self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": "Print cancelled from LCD"})
-                    self._printer.cancel_print()
-                return line
-
-        # Firmware tells us thumbnail finished
-        if line.startswith("M9001"):
-            if "thumbnail-rendered" in line:
-                self._plugin_logger.info("M9001 thumbnail-rendered received from firmware.")
-                self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
+    def _build_received_dispatch(self):
+        """Prefix tables for gcode_received_handler, keyword handlers are tried in order."""
+        self._lcd_keywords = {
+            "M9000": (
+                ("lcd-rendered", self._on_lcd_rendered),
+                ("pause-job", self._on_lcd_pause_job),
+                ("resume-job", self._on_lcd_resume_job),
+                ("cancel-job", self._on_lcd_cancel_job),
+            ),
+            "M9001": (
+                ("thumbnail-rendered", self._on_lcd_thumb_rendered),
+                ("CAPS", self.parse_thumb_caps),
+                ("HASH", self.parse_thumb_cache_reply),
+                ("CHUNK", self._on_lcd_chunk),
+                ("ACK LINE", self._on_lcd_ack_line),
+            ),
+        }
+        self._received_dispatch = {
+            "M9": self._on_lcd_line,
+            "ok": self._on_ok_line,
+            "ec": self._on_busy_line,   # 'echo:busy: processing'
+            "bu": self._on_busy_line,   # 'busy: processing'
+            "Re": self._on_resend_line,
+        }
 
-                self.sent_imagemap = True
+    def _on_lcd_line(self, line):
+        for keyword, handler in self._lcd_keywords.get(line[:5], ()):
+            if keyword in line:
+                handler(line)
+                return
 
-                # Signal the pause gate wroker (do NOT resume here to avoid PAUSING->PAUSED race)
-                self.thumb_rendered_event.set()
-                return line
+    # Firmware tells us LCD is ready
+    def _on_lcd_rendered(self, line):
+        self.is_lcd_ready = True
+        self.lcd_ready_event.set()
 
-            if "CHUNK" in line:
-                if self.get_last_chunk:
-                    try:
-                        self.chunk_index = int(line.split("|")[0].split(" ")[2])
-                    except Exception:
-                        pass
-                return line
+    def _on_lcd_pause_job(self, line):
+        if self._printer.is_printing():
+            self._printer.pause_print()
 
-            if self.txLine is not None and f"ACK LINE {self.txLine}" in line:
-                self.nextLineAck = True
-                return line
+    def _on_lcd_resume_job(self, line):
+        if self._printer.is_paused():
+            self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_purge_popup"))
+            self._printer.resume_print()
+
+    def _on_lcd_cancel_job(self, line):
+        if self._printer.is_printing() or self._printer.is_paused():
+            self._plugin_manager.send_plugin_message(self._identifier, {"type": "error_popup", "message": "Print cancelled from LCD"})
+            self._printer.cancel_print()
+
+    # Firmware tells us thumbnail finished
+    def _on_lcd_thumb_rendered(self, line):
+        self._plugin_logger.info("M9001 thumbnail-rendered received from firmware.")
+        self.on_thumb_rendered()
+
+    def _on_lcd_chunk(self, line):
+        if self.get_last_chunk or self._tx_active:
+            try:
+                self.chunk_index = int(line.split("|")[0].split(" ")[2])
+            except Exception:
+                return
+            self._on_thumb_position(self.chunk_index)
 
+    def _on_lcd_ack_line(self, line):
+        try:
+            self.txLine = int(line.split("ACK LINE", 1)[1].split()[0])
+        except Exception:
+            return
+        self.nextLineAck = True
+        if 0 <= self.txLine < len(self._tx_row_ends):
+            self._on_thumb_ack(self._tx_row_ends[self.txLine])
+
+    def _on_resend_line(self, line):
+        # Resend requests during a transfer mean the link is struggling
+        if self._tx_active and line.startswith("Resend"):
+            with self._tx_cond:
+                self._tx_resends += 1
+                self._tx_cond.notify_all()
+
+    def _on_busy_line(self, line):
         # Busy flags (optional)
         if "busy: processing" in line:
             self.printer_busy = True
             if self.get_last_chunk:
                 self.get_last_chunk = False
-            return line
 
-        if "ok" in line:
-            self.printer_busy = False
-            return line
-
-        return line
+    def _on_ok_line(self, line):
+        self.printer_busy = False
+        if self._lcd_cmd_written:
+            self._lcd_cmd_written = False
+            self._lcd_cmd_ok.set()
+        if self._tx_active and self._tx_ack_mode == "ok":
+            self._on_thumb_ok()
 
     # -----------------------
     # Sending commands
@@ -627,6 +1376,103 @@ class LCD_E3V3SEPlugin(
         """Send raw M9001 command string with internal tag."""
         self._printer.commands(value, tags={"ignore_blocker"})
 
+    def _send_handshake_cmd(self, cmd, timeout_s=5.0):
+        """
+        Send one print info command and wait until the firmware acknowledged it
+        with 'ok'. A missing 'ok' only costs timeout_s, the handshake continues.
+        Returns False if the printer went away meanwhile.
+        """
+        self._lcd_cmd_ok.clear()
+        self._lcd_cmd_written = False
+        tags = {"lcd_handshake"} if cmd.startswith("M73") else {"ignore_blocker", "lcd_handshake"}
+        self._printer.commands(cmd, tags=tags)
+
+        if not self._lcd_cmd_ok.wait(timeout=timeout_s):
+            self._plugin_logger.warning(f"No 'ok' for '{cmd}' within {timeout_s}s. Continuing anyway.")
+        if not self._printer.is_operational():
+            self._plugin_logger.warning("LCD handshake aborted: printer not operational.")
+            return False
+        return True
+
+    def _wait_lcd_ready(self, timeout_s=30.0):
+        """Wait for 'lcd-rendered'. Returns False if the printer went away meanwhile."""
+        if not self.lcd_ready_event.wait(timeout=timeout_s):
+            self._plugin_logger.warning(f"LCD wait timeout ({timeout_s:.0f}s). Continuing anyway.")
+        if not self._printer.is_operational():
+            self._plugin_logger.warning("LCD wait aborted: printer not operational.")
+            return False
+        return True
+
+    def parse_thumb_caps(self, line):
+        """Parse 'M9001 CAPS ENC:HEX,B64,RLE ...' into a dict with lowercase keys."""
+        caps = {}
+        for token in line.strip().split()[2:]:
+            key, sep, value = token.partition(":")
+            if sep:
+                caps[key.lower()] = value
+        self.thumb_caps = caps
+        self._plugin_logger.info(f"M9001 capabilities: {caps}")
+
+    def parse_thumb_cache_reply(self, line):
+        """Handle 'M9001 HASH <hash> CACHED|MISS', the answer to 'M9001 H <hash>'."""
+        parts = line.strip().split()
+        if len(parts) < 4:
+            return
+        reply_hash, status = parts[2], parts[3].lower()
+
+        with self._tx_cond:
+            pending = self._thumb_cache_query == reply_hash
+            if pending:
+                self._thumb_cache_reply = status
+                self._tx_cond.notify_all()
+
+        if status == "cached":
+            # The firmware redraws the cached image right away
+            self._plugin_logger.info(f"M9001 thumbnail {reply_hash} served from firmware cache.")
+            self._lcd_thumb_hash = reply_hash
+            self.on_thumb_rendered()
+            return
+
+        if reply_hash == self._lcd_thumb_hash:
+            self._lcd_thumb_hash = None
+            if not pending:
+                # We announced an image we believed the firmware still had, send it for real
+                self._plugin_logger.warning(f"M9001 thumbnail {reply_hash} missing from firmware cache, sending it again.")
+                threading.Thread(
+                    target=self.send_thumb_imagemap,
+                    args=(self.b64_thumb, "M9001", self.thumb_rgb565, reply_hash, self.file_path),
+                    daemon=True
+                ).start()
+
+    def on_thumb_rendered(self):
+        """The LCD shows the thumbnail: close the popup and release the pause gate."""
+        self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
+
+        self.sent_imagemap = True
+
+        # Signal the pause gate wroker (do NOT resume here to avoid PAUSING->PAUSED race)
+        self.thumb_rendered_event.set()
+
+    def has_thumb_cap(self, name):
+        """True for flags the firmware announced as '<NAME>:1' in 'M9001 CAPS'."""
+        return self.thumb_caps.get(name, "0") not in ("", "0")
+
+    def get_max_cmd_len(self):
+        """Firmware command buffer size from 'M9001 CAPS MAXLEN:<n>', or None if not reported."""
+        try:
+            max_len = int(self.thumb_caps.get("maxlen", 0))
+        except ValueError:
+            return None
+        # Anything this small is a bogus report, keep the legacy chunk sizes
+        return max_len if max_len >= 48 else None
+
+    def get_thumb_encodings(self):
+        """Chunk encodings we may use: hex always, plus the compact ones the firmware announced."""
+        if not self._cfg.enable_compact_thumb:
+            return ("hex",)
+        announced = self.thumb_caps.get("enc", "").lower().split(",")
+        return ("hex",) + tuple(enc for enc in ("b64", "rle") if enc in announced)
+
     # -----------------------
     # Timing helpers
     # -----------------------
@@ -648,153 +1494,472 @@ class LCD_E3V3SEPlugin(
         minutes = seconds // 60
         return minutes
 
+    # -----------------------
+    # Print history (ETA correction)
+    # -----------------------
+    def _history_correction(self):
+        if not self._cfg.enable_eta_correction or self.print_history is None:
+            return 1.0
+        return self.print_history.correction(self.file_path, self.slicer, self.print_profile)
+
+    def corrected_minutes(self, minutes):
+        """Slicer minutes scaled by the history correction factor."""
+        if self._eta_factor == 1.0 or minutes is None:
+            return minutes
+        try:
+            return int(round(float(minutes) * self._eta_factor))
+        except (TypeError, ValueError):
+            return minutes
+
+    def record_print_history(self, actual_s):
+        """Add a finished print (OctoPrint's job time in seconds) to the history."""
+        if self.print_history is None or not actual_s:
+            return
+        try:
+            predicted_s = float(self.print_time) * 60
+        except (TypeError, ValueError):
+            return
+        if predicted_s <= 0:
+            return
+        self.print_history.record(predicted_s, actual_s, self.file_path, self.slicer, self.print_profile)
+        self._plugin_logger.info(
+            f">>>>>> Print history: predicted {int(predicted_s)}s, actual {int(actual_s)}s, "
+            f"correction now x{self.print_history.correction(self.file_path, self.slicer, self.print_profile):.2f}"
+        )
+
     # -----------------------
     # Thumbnail pipeline
     # -----------------------
-    def send_thumb_imagemap(self, b64, o_cmd):
+    def send_thumb_imagemap(self, b64, o_cmd, b64_rgb565=None, thumb_hash=None, file_path=None):
+        """
+        Send the thumbnail, preferring the RGB565 payload pre-rendered at upload time.
+        Nothing is streamed if the firmware can show the same image from its cache.
+        file_path is the file the thumbnail belongs to, see send_image_to_marlin.
+        """
         self._plugin_logger.info(">>>>>> Sending Thumbnail Image Map")
 
-        if not b64:
+        if not b64 and not b64_rgb565:
             self._plugin_logger.warning("Thumbnail data not found.")
             self._plugin_manager.send_plugin_message(self._identifier, dict(type="close_popup"))
-            self.sent_imagemap = True
+            if self._is_selected(file_path):
+                self.sent_imagemap = True
             self.thumb_rendered_event.set()  # avoid infinite pause if no thumbnail
             return
 
-        img = self.decode_base64_image(b64)
-        pixel_data = self.get_pixel_data(img)
+        if b64_rgb565:
+            pixel_data = base64.b64decode(b64_rgb565)
+        else:
+            # Metadata from older plugin versions only has the PNG
+            img = self.decode_base64_image(b64)
+            pixel_data = to_be_bytes(self.get_pixel_data(img))
+
+        width, height = thumb_geometry(o_cmd)
+        expected_size = width * height
+        if len(pixel_data) != expected_size * 2:
+            raise ValueError(f"Expected pixel data size {expected_size}, but got {len(pixel_data) // 2}")
+
+        # Metadata from older plugin versions has no hash yet
+        thumb_hash = thumb_hash or payload_hash(pixel_data)
+        if self.is_thumb_cached(thumb_hash):
+            self._plugin_logger.info(f"Thumbnail {thumb_hash} already on the LCD, transfer skipped.")
+            return
+
+        self.send_image_to_marlin(pixel_data, o_cmd, thumb_hash, file_path)
 
-        expected_size = 96 * 96 if o_cmd == "M9001" else 26 * 240
-        if len(pixel_data) != expected_size:
-            raise ValueError(f"Expected pixel data size {expected_size}, but got {len(pixel_data)}")
+    def is_thumb_cached(self, thumb_hash, timeout_s=2.0):
+        """
+        True if the firmware can show the image with this hash without a transfer.
+        Only firmware that announced CACHE in 'M9001 CAPS' keeps a copy. If it is the
+        image we sent last on this connection it is only announced, otherwise the
+        firmware is asked and a missing or late answer counts as a miss. The query
+        also tells the firmware which hash the following transfer carries.
+        """
+        if not self.has_thumb_cap("cache"):
+            return False
 
-        self.send_image_to_marlin(pixel_data, o_cmd)
+        if thumb_hash == self._lcd_thumb_hash:
+            # Reply handling resends the image should the firmware have lost it
+            self.send_M9001_cmd(f"M9001 H {thumb_hash}")
+            return True
 
-    def send_image_to_marlin(self, pixel_data, o_cmd):
+        with self._tx_cond:
+            self._thumb_cache_query = thumb_hash
+            self._thumb_cache_reply = None
+        self.send_M9001_cmd(f"M9001 H {thumb_hash}")
+        with self._tx_cond:
+            self._tx_cond.wait_for(lambda: self._thumb_cache_reply is not None, timeout=timeout_s)
+            reply = self._thumb_cache_reply
+            self._thumb_cache_query = None
+
+        if reply is None:
+            self._plugin_logger.warning(f"No answer to 'M9001 H {thumb_hash}', sending the thumbnail.")
+        return reply == "cached"
+
+    def render_thumb_payload(self, b64, o_cmd):
+        """Base64 of the big-endian RGB565 payload for o_cmd, or None if the thumbnail can't be used."""
+        if not b64:
+            return None
+        try:
+            img = self.decode_base64_image(b64)
+            width, height = thumb_geometry(o_cmd)
+            if img.size != (width, height):
+                raise ValueError(f"Expected {width}x{height} thumbnail, but got {img.size[0]}x{img.size[1]}")
+            return base64.b64encode(rgb565_bytes(img)).decode("ascii")
+        except Exception as e:
+            self._plugin_logger.warning(f"{self.get_current_function_name()}: Could not pre-render thumbnail: {e}")
+            return None
+
+    def send_image_to_marlin(self, pixel_data, o_cmd, thumb_hash=None, file_path=None):
         """
         CRITICAL:
         When printing (or paused during print), OctoPrint uses numbered lines: 'N.. <cmd> *checksum'
         That increases line length. If the command becomes too long, Marlin may complain:
         'Error:No Checksum with line number' and request Resend forever.
 
-        Fix: Reduce pixels_per_chunk in numbered mode.
-        """
-        numbered_mode = self._printer.is_printing() or self._printer.is_paused()
+        Fix: Size every chunk from the line budget. When the firmware reports its
+        command buffer size (MAXLEN in 'M9001 CAPS'), each line is filled up to
+        that size minus the 'N<line> ' / '*<checksum>' wrapper and the 'C y x'
+        header. Otherwise fall back to the fixed 12 (numbered) / 20 pixel chunks.
 
-        # Safer default in numbered mode (keep lines short)
-        pixels_per_chunk = 12 if numbered_mode else 20
+        Payloads are hex ('C' lines) unless the firmware announced the compact
+        base64 ('B') or run-length ('R') encodings, which fit more pixels per line.
+
+        A transfer started while the printer is only operational uses the longer
+        unnumbered lines. If a print starts before it is done, the unnumbered lines
+        still queued are dropped in the sending phase and the rest of the image is
+        re-chunked for numbered mode.
+
+        thumb_hash is remembered once the transfer completes, so the firmware's
+        cached copy can be reused next time. Both that and sent_imagemap are only
+        recorded while file_path is still the selected file; selecting another
+        file aborts the transfer.
+        """
+        numbered_mode = self._is_numbered_mode()
+        encodings = self.get_thumb_encodings()
 
         self._plugin_logger.info(
-            f"Starting HEX thumbnail transmission (pixels_per_chunk={pixels_per_chunk}, numbered_mode={numbered_mode})"
+            f"Starting thumbnail transmission (max_cmd_len={self.get_max_cmd_len()}, encodings={encodings}, numbered_mode={numbered_mode})"
         )
 
         try:
-            self._printer.commands(f"{o_cmd} START", tags={"ignore_blocker"})
-
-            for y in range(96):
-                start_idx = y * 96
-                line_data = pixel_data[start_idx:start_idx + 96]
-                hex_string = "".join(f"{val:04X}" for val in line_data)
+            payload = to_be_bytes(pixel_data)
+            lines, line_pos = self._build_thumb_lines(payload, o_cmd, encodings, numbered_mode)
 
-                step = pixels_per_chunk * 4  # 4 hex chars per pixel
+            # Whatever the firmware cached is overwritten from here on
+            self._lcd_thumb_hash = None
+            self._printer.commands(f"{o_cmd} START", tags={"ignore_blocker"})
+            tx_seq = self._begin_thumb_tx()
+            try:
+                sent = 0
+                while True:
+                    rebuild_at = self._send_thumb_lines(lines, line_pos, numbered_mode, sent, tx_seq=tx_seq)
+                    if rebuild_at is None:
+                        break
 
-                for i in range(0, len(hex_string), step):
-                    chunk_hex = hex_string[i:i + step]
-                    x_offset = i // 4
-                    command = f"{o_cmd} C {y} {x_offset} {chunk_hex}"
-                    self._printer.commands(command, tags={"ignore_blocker"})
+                    # A print started mid-transfer, continue with numbered-size lines
+                    numbered_mode = True
+                    self._plugin_logger.info(f"Thumbnail TX: print started, re-chunking from line {rebuild_at}/{len(lines)}")
+                    if rebuild_at < len(lines):
+                        tail_lines, tail_pos = self._build_thumb_lines(
+                            payload, o_cmd, encodings, numbered_mode, start=line_pos[rebuild_at]
+                        )
+                        lines = lines[:rebuild_at] + tail_lines
+                        line_pos = line_pos[:rebuild_at] + tail_pos
+                    sent = rebuild_at
+            finally:
+                with self._tx_cond:
+                    # An abort may already have handed the state to a newer transfer
+                    if self._tx_seq == tx_seq:
+                        self._tx_active = False
 
             self._printer.commands(f"{o_cmd} END", tags={"ignore_blocker"})
-            self.sent_imagemap = True
+            if self._is_selected(file_path):
+                self.sent_imagemap = True
+                self._lcd_thumb_hash = thumb_hash
+            else:
+                self._plugin_logger.info(f"Thumbnail of {file_path} sent after another file was selected, not recorded.")
 
         except Exception as e:
+            if not self._is_selected(file_path):
+                self._plugin_logger.info(f"Thumbnail of {file_path} dropped, another file was selected: {e}")
+                return
             self._plugin_logger.error(f"send_image_to_marlin error: {e}")
             # If we fail, unblock the pause gate to avoid leaving the printer paused forever
             self.thumb_rendered_event.set()
 
+    def _is_numbered_mode(self):
+        """True while OctoPrint wraps every line in 'N<line> ... *<checksum>'."""
+        return (
+            self._printer.is_printing()
+            or self._printer.is_paused()
+            or self._cfg.always_send_checksum
+        )
+
+    def _build_thumb_lines(self, payload, o_cmd, encodings, numbered_mode, start=(0, 0)):
+        """Chunk lines and their (row, x) positions for the image from position start onwards."""
+        width, height = thumb_geometry(o_cmd)
+        row_bytes = width * 2
+        max_cmd_len = self.get_max_cmd_len()
+
+        # Safer default in numbered mode (keep lines short), 4 hex chars per pixel
+        pixels_per_chunk = 12 if numbered_mode else 20
+        fixed_budget = pixels_per_chunk * 4
+
+        lines = []
+        line_pos = []
+        first_row, first_x = start
+
+        for y in range(first_row, height):
+            start_idx = y * row_bytes
+            row = payload[start_idx:start_idx + row_bytes]
+
+            if max_cmd_len:
+                budget = functools.partial(chunk_budget, max_cmd_len, o_cmd, numbered_mode, y)
+            else:
+                budget = fixed_budget
+
+            row_start = first_x if y == first_row else 0
+            for x_offset, tag, chunk in iter_row_chunks(row, encodings, budget, start=row_start):
+                lines.append(f"{o_cmd} {tag} {y} {x_offset} {chunk}")
+                line_pos.append((y, x_offset))
+
+        return lines, line_pos
+
+    def _begin_thumb_tx(self):
+        """Reset the transfer state for a new image. Returns the transfer's sequence number."""
+        with self._tx_cond:
+            self._tx_acked = 0
+            self._tx_position = None
+            self._tx_resends = 0
+            self._tx_inflight = 0
+            self._tx_written = -1
+            self._tx_ok_pending = 0
+            self._tx_row_ends = []
+            self._tx_ack_mode = "ack" if self.has_thumb_cap("ack") else "ok"
+            self._tx_active = True
+            self._tx_seq += 1
+            return self._tx_seq
+
+    def _abort_thumb_tx(self):
+        """Stop a running transfer, its sender gives up at the next check."""
+        with self._tx_cond:
+            self._tx_seq += 1
+            self._tx_active = False
+            self._tx_cond.notify_all()
+
+    def _on_thumb_ack(self, acked):
+        """Record how many chunk lines of the current transfer are confirmed and wake the sender."""
+        with self._tx_cond:
+            if acked > self._tx_acked:
+                self._tx_acked = acked
+                self._tx_cond.notify_all()
+
+    def _on_thumb_ok(self):
+        """
+        'ok' while a transfer runs without firmware ACKs. Only an 'ok' owed to a chunk
+        line the sending hook has written counts, those for M105 polls or our other
+        commands don't, and never more lines than were written are confirmed.
+        """
+        with self._tx_cond:
+            if self._tx_ok_pending <= 0:
+                return
+            self._tx_ok_pending -= 1
+            acked = min(self._tx_acked + 1, self._tx_written + 1)
+            if acked > self._tx_acked:
+                self._tx_acked = acked
+                self._tx_cond.notify_all()
+
+    def _on_thumb_position(self, count):
+        """Firmware reported how many chunk lines it has applied ('M9001 CHUNK <count>')."""
+        with self._tx_cond:
+            self._tx_position = count
+            if count > self._tx_acked:
+                self._tx_acked = count
+            self._tx_cond.notify_all()
+
+    def _on_thumb_line_sending(self, tags):
+        """
+        Sending-phase check for our chunk lines. Lines built for unnumbered mode
+        are dropped once OctoPrint numbers lines, they would overflow the firmware
+        buffer. Returns a hook result.
+        """
+        index = None
+        for tag in tags:
+            if tag.startswith("lcd_thumb_line:"):
+                index = int(tag[len("lcd_thumb_line:"):])
+
+        with self._tx_cond:
+            self._tx_inflight -= 1
+            self._tx_cond.notify_all()
+            if "lcd_thumb_unnumbered" in tags and self._is_numbered_mode():
+                return None,
+            if index is not None:
+                self._tx_written = index
+                if self._tx_ack_mode == "ok":
+                    self._tx_ok_pending += 1
+        return None
+
+    def _query_thumb_position(self, timeout_s):
+        """Ask the firmware for its CHUNK count. Returns None if it doesn't answer in time."""
+        with self._tx_cond:
+            self._tx_position = None
+        self.get_last_chunk = True
+        self.send_M9001_cmd("M9001 CHUNK")
+        with self._tx_cond:
+            self._tx_cond.wait_for(lambda: self._tx_position is not None or not self._tx_active, timeout=timeout_s)
+            return self._tx_position
+
+    def _send_thumb_lines(self, lines, line_pos, numbered_mode, sent=0, ack_timeout_s=2.0, resume_after_s=6.0,
+                          max_resumes=3, max_window=32, tx_seq=None):
+        """
+        Sliding-window sender for the chunk lines of one image, starting at line `sent`.
+
+        At most `window` lines are handed to OctoPrint without being confirmed, so
+        its send queue never fills with hundreds of our lines and temperature polls
+        or user commands still get through. Confirmation comes from the firmware's
+        'ACK LINE <row>' / 'CHUNK <count>' reports if it announced ACK in its
+        capabilities, otherwise the 'ok' owed to each written chunk line.
+
+        The window grows by one each time a full window is confirmed, is halved
+        whenever no confirmation arrives within ack_timeout_s and drops to one line
+        while the firmware keeps asking for resends.
+
+        If nothing is confirmed for resume_after_s the firmware is asked how many
+        lines it really has ('M9001 CHUNK') and sending resumes from there instead
+        of waiting for the pause gate timeout. Lines are idempotent (they carry
+        their own row/offset), so re-sending a few is harmless.
+
+        Returns None when done, or the index of the first line that has to be
+        rebuilt because OctoPrint switched to numbered lines mid-transfer. Raises
+        once the transfer is aborted or a newer one (other than tx_seq) started.
+        """
+        window = max(self._cfg.thumb_window or 8, 1)
+        total = len(lines)
+
+        row_ends = []  # number of chunk lines up to and including row y
+        for i, (y, _) in enumerate(line_pos):
+            while len(row_ends) <= y:
+                row_ends.append(i)
+            row_ends[y] = i + 1
+
+        line_tags = {"ignore_blocker", "lcd_thumb"}
+        if not numbered_mode:
+            line_tags.add("lcd_thumb_unnumbered")
+
+        with self._tx_cond:
+            self._tx_row_ends = row_ends
+            self._tx_acked = min(self._tx_acked, sent)
+            ack_mode = self._tx_ack_mode
+
+        last_acked = sent
+        seen_resends = self._tx_resends
+        resumes = 0
+        grow_at = sent + window
+        last_progress = last_backoff = time.time()
+
+        while True:
+            with self._tx_cond:
+                waiting = sent >= total or sent - self._tx_acked >= window
+                if self._tx_active and waiting:
+                    self._tx_cond.wait(timeout=ack_timeout_s)
+                acked = self._tx_acked
+                resends = self._tx_resends
+                active = self._tx_active and (tx_seq is None or self._tx_seq == tx_seq)
+
+            if not active:
+                raise RuntimeError("thumbnail transfer cancelled")
+
+            if not numbered_mode and self._is_numbered_mode():
+                # Let everything already queued pass the sending hook, then rebuild
+                # from the first line that did not make it out
+                with self._tx_cond:
+                    self._tx_cond.wait_for(lambda: self._tx_inflight <= 0, timeout=ack_timeout_s)
+                    return self._tx_written + 1
+
+            # Without firmware ACKs 'ok' is all we get, so everything sent counts as done
+            if sent >= total and (ack_mode == "ok" or acked >= total):
+                break
+
+            if resends > seen_resends:
+                seen_resends = resends
+                window = 1
+                grow_at = acked + 1
+                self._plugin_logger.warning(f"Thumbnail TX: resend requested, window reduced to 1 at line {acked}/{total}")
+
+            now = time.time()
+            if acked > last_acked:
+                last_acked = acked
+                last_progress = now
+                if acked >= grow_at:
+                    window = min(window + 1, max_window)
+                    grow_at = acked + window
+
+            elif waiting and now - max(last_progress, last_backoff) >= ack_timeout_s:
+                if not self._printer.is_operational():
+                    raise RuntimeError("printer not operational")
+
+                if now - last_progress >= resume_after_s:
+                    # Stalled: resume from what the firmware confirms it has
+                    resumes += 1
+                    if resumes > max_resumes:
+                        raise TimeoutError(f"no progress after {max_resumes} resumes at line {acked}/{total}")
+
+                    position = self._query_thumb_position(ack_timeout_s)
+                    if position is None:
+                        position = max(acked - window, 0)
+                    position = min(position, total)
+
+                    with self._tx_cond:
+                        self._tx_acked = position
+                    sent = last_acked = position
+                    window = max(window // 2, 1)
+                    grow_at = position + window
+                    last_progress = time.time()
+                    self._plugin_logger.warning(
+                        f"Thumbnail TX: stalled, resuming at line {position}/{total} (attempt {resumes})"
+                    )
+                    continue
+
+                # Nothing confirmed for a whole ACK timeout, back off
+                if window > 1:
+                    window = max(window // 2, 1)
+                    self._plugin_logger.info(f"Thumbnail TX: no ACK progress, window reduced to {window}")
+                grow_at = acked + window
+                last_backoff = now
+                continue
+
+            burst = min(window - (sent - acked), total - sent)
+            for i in range(sent, sent + burst):
+                with self._tx_cond:
+                    self._tx_inflight += 1
+                self._printer.commands(lines[i], tags=line_tags | {f"lcd_thumb_line:{i}"})
+            sent += max(burst, 0)
+
+        self._plugin_logger.info(
+            f"Thumbnail TX: {total} lines sent ({ack_mode} mode, final window {window}, resumes {resumes})"
+        )
+        return None
+
     def decode_base64_image(self, b64_string):
         image_data = base64.b64decode(b64_string)
         return Image.open(io.BytesIO(image_data))
 
     def get_pixel_data(self, image):
-        img = image.convert("RGB")
-        width, height = img.size
-        imgbytes = img.tobytes()
-
-        pixel_map = []
-        for y in range(height):
-            for x in range(width):
-                idx = (y * width + x) * 3
-                r_scaled = (imgbytes[idx] * 31) // 255
-                g_scaled = (imgbytes[idx + 1] * 63) // 255
-                b_scaled = (imgbytes[idx + 2] * 31) // 255
-                color16bit = (r_scaled << 11) | (g_scaled << 5) | b_scaled
-                pixel_map.append(color16bit)
-        return pixel_map
+        """RGB565 pixels as array('H'), converted with PIL band lookups instead of a per-pixel loop."""
+        return rgb565_array(image)
 
     # -----------------------
     # Parsers
     # -----------------------
     def find_total_layers_from_content(self, file_content):
-        for line in file_content.splitlines():
-            if "; total layer number:" in line:
-                return line.strip().split(":")[-1].strip()
-            if ";LAYER_COUNT:" in line:
-                return line.strip().split(":")[-1].strip()
-        return None
+        return scan_content(file_content).total_layers
 
     def find_first_m73_from_content(self, file_content):
-        for line in file_content.splitlines():
-            m73_match = re.match(r"M73 P(\d+)(?: R(\d+))?", line)
-            if m73_match:
-                progress = int(m73_match.group(1))
-                remaining_minutes = int(m73_match.group(2)) if m73_match.group(2) else 0
-                if progress == 0:
-                    return progress, remaining_minutes
-        return 0, 0
+        scanner = scan_content(file_content)
+        return scanner.progress, scanner.remaining
 
     def extract_thumbnail_from_content(self, file_content):
-        thumbnail = None
-        collecting = False
-        current_thumbnail = []
-        slicer_type = None
-
-        for line in file_content.splitlines():
-            line = line.strip()
-
-            if "; generated by OrcaSlicer" in line:
-                slicer_type = "OrcaSlicer"
-            elif ";Generated with Cura" in line:
-                slicer_type = "Cura"
-
-            if slicer_type == "OrcaSlicer":
-                if line == "; THUMBNAIL_BLOCK_START":
-                    collecting = False
-                    current_thumbnail = []
-
-                if line.startswith("; thumbnail begin 96x96") or line.startswith("; thumbnail_PNG begin 96x96"):
-                    collecting = True
-                    continue
-
-                if collecting:
-                    if line.startswith("; thumbnail end") or line.startswith("; thumbnail_PNG end"):
-                        collecting = False
-                        thumbnail = "".join(current_thumbnail)
-                        break
-                    current_thumbnail.append(line.lstrip("; ").rstrip())
-
-            elif slicer_type == "Cura":
-                if line.startswith("; thumbnail begin 96x96"):
-                    collecting = True
-                    current_thumbnail = []
-                    continue
-
-                if collecting:
-                    if line.startswith("; thumbnail end"):
-                        collecting = False
-                        thumbnail = "".join(current_thumbnail)
-                        break
-                    current_thumbnail.append(line.lstrip("; ").rstrip())
+        thumbnail = scan_content(file_content).thumbnail
 
         if thumbnail:
             self._plugin_logger.info(f"Extracted thumbnail, size: {len(thumbnail)} characters")
@@ -807,6 +1972,15 @@ class LCD_E3V3SEPlugin(
     # Cleanup
     # -----------------------
     def cleanup(self):
+        # Stop the live progress push
+        with self._progress_lock:
+            if self._progress_timer is not None:
+                self._progress_timer.cancel()
+                self._progress_timer = None
+            self._progress_state = None
+            self._progress_sent = None
+        self._max_z = None
+
         # Reset job timing
         self.start_time = None
         self.elapsed_time = None
@@ -815,9 +1989,13 @@ class LCD_E3V3SEPlugin(
         self.print_time = None
         self.progress = None
         self.myETA = None
+        self._eta_factor = 1.0
+        self._reset_layer_index()
 
         # Reset LCD / print state
         self.is_lcd_ready = False
+        self.lcd_ready_event.clear()
+        self._lcd_cmd_written = False
         self.current_layer = 0
         self.total_layers = 0
         self.print_finish = False
@@ -830,6 +2008,9 @@ class LCD_E3V3SEPlugin(
         self.txLine = None
         self.nextLineAck = False
 
+        # Abort a running thumbnail transfer
+        self._abort_thumb_tx()
+
         # Stop gates (never keep the printer paused because of us)
         self._stop_pause_gate()
         self.thumb_rendered_event.clear()
@@ -839,6 +2020,7 @@ class LCD_E3V3SEPlugin(
         with self._metadata_lock:
             self._metadata_running = False
             self._metadata_last_file = None
+            self._metadata_thumb_wanted = False
 
    
     def get_update_information(self):
@@ -868,5 +2050,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.filemanager.preprocessor": __plugin_implementation__.file_preprocessor,
         "octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.gcode_sending_handler,
+        "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.gcode_sending_handler,
         "octoprint.comm.protocol.gcode.received": __plugin_implementation__.gcode_received_handler,
     }
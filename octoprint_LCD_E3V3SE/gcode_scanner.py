@@ -0,0 +1,515 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import re
+import sys
+import mmap
+import base64
+import bisect
+import hashlib
+from array import array
+
+# Granularity of the scanned header window and of the fingerprinted slices
+CHUNK_SIZE = 64 * 1024
+
+# A single G-code line longer than this is not something we parse (slicer config
+# dumps, binary garbage); it is dropped instead of growing the line buffer.
+MAX_LINE_LENGTH = 64 * 1024
+
+# Slice size for bytes.find() over mapped files, a marker near the top never
+# makes the search page in the rest of the file
+SEARCH_STEP = 1024 * 1024
+
+_M73_RE = re.compile(rb"M73 P(\d+)(?: R(\d+))?")
+
+_LAYER_MARKERS = (b"; total layer number:", b";LAYER_COUNT:")
+
+# Layer change comments (Orca/Prusa style first, then Cura) for the offset index
+_LAYER_CHANGE_MARKERS = (b";LAYER_CHANGE", b";LAYER:")
+# Every line the index needs (layer changes and 'M73 P.. R..'), found in one pass
+_INDEX_LINE_RE = re.compile(rb"(;LAYER_CHANGE|;LAYER:|M73 P\d+ R(\d+))")
+_INDEX_RE = re.compile(rb"\n" + _INDEX_LINE_RE.pattern)
+_Z_PARAM_RE = re.compile(rb"^G[01] [^;]*?Z(-?(?:\d+\.?\d*|\.\d+))")
+_EXTRUDE_RE = re.compile(rb"^G1 (?=[^\n;]*[XY])[^\n;]*E\.?\d", re.M)
+
+# Print profile line of the Orca/Prusa config block, written at the end of the file
+_PROFILE_MARKER = b"\n; print_settings_id = "
+PROFILE_TAIL = 1024 * 1024
+
+_ORCA_MARKER = b"; generated by OrcaSlicer"
+_CURA_MARKER = b";Generated with Cura"
+
+_ORCA_THUMB_BEGIN = (b"; thumbnail begin 96x96", b"; thumbnail_PNG begin 96x96")
+_ORCA_THUMB_END = (b"; thumbnail end", b"; thumbnail_PNG end")
+_CURA_THUMB_BEGIN = b"; thumbnail begin 96x96"
+_CURA_THUMB_END = b"; thumbnail end"
+
+
+class GcodeScanner(object):
+    """
+    Incremental single-pass scanner for the metadata the LCD needs.
+
+    Feed raw bytes in chunks of any size with feed() and call finish() at the end.
+    Layer count, 96x96 thumbnail and first 'M73 P0' are extracted with the same
+    rules the old per-field parsers used, without ever holding the whole file.
+    """
+
+    def __init__(self):
+        self.total_layers = None
+        self.thumbnail = None
+        self.progress = 0
+        self.remaining = 0
+        self.slicer_type = None
+
+        self._m73_found = False
+        self._thumb_done = False
+        self._collecting = False
+        self._thumb_parts = []
+        self._pending = b""
+
+    @property
+    def complete(self):
+        """True once every field has been found and reading can stop."""
+        return self.total_layers is not None and self._thumb_done and self._m73_found
+
+    # -----------------------
+    # Feeding
+    # -----------------------
+    def feed(self, data):
+        if self._pending:
+            data = self._pending + data
+
+        lines = data.split(b"\n")
+        self._pending = lines.pop()
+        if len(self._pending) > MAX_LINE_LENGTH:
+            self._pending = b""
+
+        for line in lines:
+            if line:
+                self._scan_line(line)
+
+    def finish(self):
+        if self._pending:
+            self._scan_line(self._pending)
+            self._pending = b""
+        return self
+
+    # -----------------------
+    # Line handlers
+    # -----------------------
+    def _scan_line(self, line):
+        # Inside a thumbnail block every line belongs to the image
+        if self._collecting:
+            self._scan_thumbnail(line.strip())
+            return
+
+        head = line[:1]
+
+        # Most of a G-code file is moves; only comments and M73 matter here
+        if head == b"M":
+            if not self._m73_found:
+                self._scan_m73(line)
+            return
+
+        if head == b";" or head in (b" ", b"\t"):
+            if self.total_layers is None:
+                self._scan_layers(line)
+            if not self._thumb_done:
+                self._scan_thumbnail(line.strip())
+
+    def _scan_layers(self, line):
+        for marker in _LAYER_MARKERS:
+            if marker in line:
+                value = line.strip().split(b":")[-1].strip()
+                self.total_layers = value.decode("utf-8", errors="ignore")
+                return
+
+    def _scan_m73(self, line):
+        m73_match = _M73_RE.match(line)
+        if m73_match and int(m73_match.group(1)) == 0:
+            self.progress = 0
+            self.remaining = int(m73_match.group(2)) if m73_match.group(2) else 0
+            self._m73_found = True
+
+    def _scan_thumbnail(self, line):
+        if _ORCA_MARKER in line:
+            self.slicer_type = "OrcaSlicer"
+        elif _CURA_MARKER in line:
+            self.slicer_type = "Cura"
+
+        if self.slicer_type == "OrcaSlicer":
+            if line == b"; THUMBNAIL_BLOCK_START":
+                self._collecting = False
+                self._thumb_parts = []
+
+            if line.startswith(_ORCA_THUMB_BEGIN):
+                self._collecting = True
+                return
+
+            if self._collecting:
+                if line.startswith(_ORCA_THUMB_END):
+                    self._end_thumbnail()
+                    return
+                self._thumb_parts.append(line.lstrip(b"; ").rstrip())
+
+        elif self.slicer_type == "Cura":
+            if line.startswith(_CURA_THUMB_BEGIN):
+                self._collecting = True
+                self._thumb_parts = []
+                return
+
+            if self._collecting:
+                if line.startswith(_CURA_THUMB_END):
+                    self._end_thumbnail()
+                    return
+                self._thumb_parts.append(line.lstrip(b"; ").rstrip())
+
+    def _end_thumbnail(self):
+        self._collecting = False
+        self._thumb_done = True
+        self.thumbnail = b"".join(self._thumb_parts).decode("ascii", errors="ignore") or None
+        self._thumb_parts = []
+
+
+def scan_content(file_content):
+    """Run the scanner over an already decoded G-code string."""
+    scanner = GcodeScanner()
+    scanner.feed(file_content.encode("utf-8"))
+    return scanner.finish()
+
+
+# -----------------------
+# Memory-mapped scanning
+# -----------------------
+class MappedScan(object):
+    """
+    Same fields as GcodeScanner, found with bytes.find() over an mmap of a stored
+    file. Only the header window and, for fields still missing, the tail window
+    are searched, so only those pages are ever read. Decoding is limited to the
+    lines that hold a value.
+    """
+
+    def __init__(self, data, header_bytes=0, tail_bytes=0):
+        self.total_layers = None
+        self.thumbnail = None
+        self.progress = 0
+        self.remaining = 0
+        self.slicer_type = None
+
+        self._m73_found = False
+        self._data = data
+        size = len(data)
+        self.size = size
+
+        # The header window is scanned in whole chunks
+        header_end = min(-(-header_bytes // CHUNK_SIZE) * CHUNK_SIZE, size) if header_bytes else size
+        windows = [(0, header_end)]
+        if header_end < size and tail_bytes:
+            windows.append((max(header_end, size - tail_bytes), size))
+
+        self.bytes_read = sum(end - start for start, end in windows)
+        self.eof = windows[-1][1] == size
+
+        digest = hashlib.blake2b(digest_size=16)
+        for start, end in windows:
+            digest.update(data[start:min(end, start + CHUNK_SIZE)])
+            if end - start > CHUNK_SIZE:
+                digest.update(data[max(end - CHUNK_SIZE, start + CHUNK_SIZE):end])
+        if not self.eof:
+            # The end of the file (config block, end G-code) even if the tail was not scanned
+            digest.update(data[max(size - CHUNK_SIZE, header_end):size])
+        self._fingerprint = f"{size:x}-{digest.hexdigest()}"
+
+        for start, end in windows:
+            if self.complete:
+                break
+            self._scan_window(start, end)
+
+        self._data = None
+
+    @property
+    def complete(self):
+        return self.total_layers is not None and self.thumbnail is not None and self._m73_found
+
+    @property
+    def fingerprint(self):
+        """File size plus a hash of the first and last 64 KB of each scanned window and of the file."""
+        return self._fingerprint
+
+    # -----------------------
+    # Line helpers
+    # -----------------------
+    def _line_at(self, pos, start, end):
+        """(line_start, line_end) of the line containing pos, clamped to the window."""
+        line_start = self._data.rfind(b"\n", start, pos) + 1 or start
+        line_end = self._data.find(b"\n", pos, end)
+        return max(line_start, start), (end if line_end < 0 else line_end)
+
+    def _first_line(self, markers, start, end, accept):
+        """
+        (line_start, line_end) of the first line in the window that contains one of
+        markers and passes accept(line_start, line_end, marker_pos), or None.
+        The window is searched in SEARCH_STEP slices so a hit near the top never
+        touches the rest of the file.
+        """
+        seg_start = start
+        while seg_start < end:
+            seg_end = min(seg_start + SEARCH_STEP, end)
+            best = None
+            for marker in markers:
+                # Let a marker straddle the slice border, it's owned by this slice
+                pos = self._data.find(marker, seg_start, min(seg_end + len(marker) - 1, end))
+                while 0 <= pos < seg_end and (best is None or pos < best[0]):
+                    line_start, line_end = self._line_at(pos, start, end)
+                    # A window that starts mid-line only sees part of that line, skip it
+                    partial = line_start == start and start > 0 and self._data[start - 1:start] != b"\n"
+                    if not partial and accept(line_start, line_end, pos):
+                        best = (line_start, line_end)
+                        break
+                    pos = self._data.find(marker, line_end, min(seg_end + len(marker) - 1, end))
+            if best is not None:
+                return best
+            seg_start = seg_end
+        return None
+
+    def _is_comment(self, line_start, line_end, pos):
+        return self._data[line_start:line_start + 1] in (b";", b" ", b"\t")
+
+    def _starts_line(self, line_start, line_end, pos):
+        return not self._data[line_start:pos].strip()
+
+    # -----------------------
+    # Fields
+    # -----------------------
+    def _scan_window(self, start, end):
+        if self.total_layers is None:
+            self._scan_layers(start, end)
+        if not self._m73_found:
+            self._scan_m73(start, end)
+        if self.thumbnail is None:
+            self._scan_thumbnail(start, end)
+
+    def _scan_layers(self, start, end):
+        # Only comment lines count, like in the line scanner
+        found = self._first_line(_LAYER_MARKERS, start, end, self._is_comment)
+        if found is not None:
+            line = self._data[found[0]:found[1]]
+            self.total_layers = line.strip().split(b":")[-1].strip().decode("utf-8", errors="ignore")
+
+    def _scan_m73(self, start, end):
+        def _is_m73_p0(line_start, line_end, pos):
+            m73_match = _M73_RE.match(self._data[line_start:line_end])
+            return bool(m73_match) and int(m73_match.group(1)) == 0
+
+        found = self._first_line((b"M73 P",), start, end, _is_m73_p0)
+        if found is not None:
+            m73_match = _M73_RE.match(self._data[found[0]:found[1]])
+            self.progress = 0
+            self.remaining = int(m73_match.group(2)) if m73_match.group(2) else 0
+            self._m73_found = True
+
+    def _scan_thumbnail(self, start, end):
+        found = self._first_line((_ORCA_MARKER, _CURA_MARKER), start, end, self._starts_line)
+        if found is None:
+            return
+
+        if _ORCA_MARKER in self._data[found[0]:found[1]]:
+            self.slicer_type = "OrcaSlicer"
+            begin_markers, end_markers = _ORCA_THUMB_BEGIN, _ORCA_THUMB_END
+        else:
+            self.slicer_type = "Cura"
+            begin_markers, end_markers = (_CURA_THUMB_BEGIN,), (_CURA_THUMB_END,)
+
+        # The slicer line has to come first, just like in the line scanner
+        begin = self._first_line(begin_markers, found[1], end, self._starts_line)
+        if begin is None:
+            return
+        stop = self._first_line(end_markers, begin[1], end, self._starts_line)
+        if stop is None:
+            return
+
+        parts = []
+        for raw in self._data[begin[1] + 1:stop[0]].split(b"\n"):
+            line = raw.strip()
+            if line:
+                parts.append(line.lstrip(b"; ").rstrip())
+        self.thumbnail = b"".join(parts).decode("ascii", errors="ignore") or None
+
+
+def _scan_mapped(path, scan):
+    """Call scan(data) with the file memory-mapped (empty files, which cannot be mapped, as b"")."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return scan(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return scan(data)
+
+
+def scan_file(path, header_bytes, tail_bytes):
+    """Scan a stored G-code file through mmap (see MappedScan)."""
+    return _scan_mapped(path, lambda data: MappedScan(data, header_bytes, tail_bytes))
+
+
+# -----------------------
+# Layer offset index
+# -----------------------
+def _z_offsets(data):
+    """
+    Fallback without layer comments: a layer starts at the move to a new highest Z
+    that is then printed at. A Z only counts once an extruding XY move follows
+    before the next Z move, so z-hops (travel up and back down) are not layers.
+    """
+    offsets = array("Q")
+    top = None
+    pending = None  # (z, line start, line end) of the last Z move
+
+    def _printed(z, start, end):
+        return (top is None or z > top + 1e-6) and _EXTRUDE_RE.search(data, start, end) is not None
+
+    line_end = -1
+    pos = data.find(b"Z")
+    while pos >= 0:
+        if pos > line_end:
+            line_start = data.rfind(b"\n", 0, pos) + 1
+            line_end = data.find(b"\n", pos)
+            if line_end < 0:
+                line_end = len(data)
+            z_match = _Z_PARAM_RE.match(data[line_start:line_end])
+            if z_match:
+                if pending is not None and _printed(pending[0], pending[1], line_start):
+                    top = pending[0]
+                    offsets.append(pending[1])
+                pending = (float(z_match.group(1)), line_start, line_end)
+        pos = data.find(b"Z", max(pos + 1, line_end))
+
+    if pending is not None and _printed(pending[0], pending[1], len(data)):
+        offsets.append(pending[1])
+    return offsets
+
+
+def _index_lines(data):
+    """
+    Offsets of the lines starting with each layer change marker, plus offsets and
+    remaining minutes of every 'M73 P.. R..' line, collected in one pass.
+    """
+    markers = {marker: array("Q") for marker in _LAYER_CHANGE_MARKERS}
+    m73_offsets, m73_remaining = array("Q"), array("I")
+
+    def _add(offset, match):
+        if match.group(2) is not None:
+            m73_offsets.append(offset)
+            m73_remaining.append(int(match.group(2)))
+        else:
+            markers[match.group(1)].append(offset)
+
+    # The first line has no newline in front of it
+    first = _INDEX_LINE_RE.match(data)
+    if first:
+        _add(0, first)
+    for match in _INDEX_RE.finditer(data):
+        _add(match.start() + 1, match)
+    return markers, m73_offsets, m73_remaining
+
+
+def layer_index(data):
+    """
+    Layer start offsets (array('Q')) and the remaining minutes at each of them
+    (array('I'), empty without M73 R), from a single pass over the file. Only
+    files without layer comments take a second one for the Z-move fallback.
+    """
+    markers, m73_offsets, m73_remaining = _index_lines(data)
+    for marker in _LAYER_CHANGE_MARKERS:
+        offsets = markers[marker]
+        if offsets:
+            break
+    else:
+        offsets = _z_offsets(data)
+    return offsets, layer_remaining(offsets, m73_offsets, m73_remaining)
+
+
+def layer_remaining(offsets, m73_offsets, m73_remaining):
+    """
+    Remaining minutes in effect where each layer starts: the last M73 R before the
+    layer change, or the first one of the file for layers ahead of it. Empty when
+    the file has no M73 R at all.
+    """
+    table = array("I")
+    if not m73_remaining:
+        return table
+    last = m73_remaining[0]
+    i = 0
+    for offset in offsets:
+        while i < len(m73_offsets) and m73_offsets[i] <= offset:
+            last = m73_remaining[i]
+            i += 1
+        table.append(last)
+    return table
+
+
+def scan_layer_index(path):
+    """
+    (layer offsets, per-layer remaining time table, print profile) of a stored
+    file. One mapping, one pass for the index; the profile is read from its tail.
+    """
+    def _scan(data):
+        offsets, remaining = layer_index(data)
+        return offsets, remaining, print_profile(data)
+
+    return _scan_mapped(path, _scan)
+
+
+# -----------------------
+# Print profile
+# -----------------------
+def print_profile(data, tail_bytes=PROFILE_TAIL):
+    """Print profile name from the config block at the end of Orca/Prusa files, or None."""
+    start = max(len(data) - tail_bytes, 0)
+    pos = data.rfind(_PROFILE_MARKER, start)
+    if pos < 0:
+        return None
+    value_start = pos + len(_PROFILE_MARKER)
+    value_end = data.find(b"\n", value_start)
+    value = data[value_start:value_end if value_end >= 0 else len(data)]
+    return value.strip().strip(b'"').decode("utf-8", errors="ignore") or None
+
+
+def encode_offsets(offsets, typecode="Q"):
+    """array -> base64 of the little-endian values, for the metadata JSON."""
+    offsets = array(typecode, offsets)
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return base64.b64encode(offsets.tobytes()).decode("ascii")
+
+
+def decode_offsets(encoded, typecode="Q"):
+    if not encoded:
+        return None
+    offsets = array(typecode)
+    offsets.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return offsets
+
+
+def layer_at(offsets, filepos):
+    """1-based layer that the byte at filepos belongs to (0 before the first layer)."""
+    return bisect.bisect_right(offsets, filepos)
+
+
+def remaining_at(offsets, remaining, filepos, size):
+    """
+    Remaining minutes at filepos, interpolated between the table values of the
+    layer containing filepos and the next one (0 at the end of the file).
+    """
+    if not remaining or len(remaining) != len(offsets):
+        return None
+    i = bisect.bisect_right(offsets, filepos) - 1
+    if i < 0:
+        return remaining[0]
+    start = offsets[i]
+    end, next_remaining = (offsets[i + 1], remaining[i + 1]) if i + 1 < len(offsets) else (size or start, 0)
+    if end <= start:
+        return remaining[i]
+    done = min(max(filepos - start, 0), end - start) / (end - start)
+    return int(round(remaining[i] - (remaining[i] - next_remaining) * done))
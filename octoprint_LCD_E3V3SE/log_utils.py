@@ -0,0 +1,72 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+import logging
+import threading
+
+# Per-category limits for chatty log lines, selected with extra={"category": ...}.
+#   sample     only every n-th record of the category is considered
+#   burst      at most this many records pass per window
+#   window_s   length of the rate window in seconds
+# Records without a category, or of level WARNING and above, always pass.
+LOG_RATE_LIMITS = {
+    "m73": dict(sample=10, burst=6, window_s=60.0),
+    "event": dict(sample=1, burst=30, window_s=10.0),
+}
+
+# Longest string value written as-is by loggable()
+MAX_LOGGED_VALUE = 96
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops records of rate-limited categories before they are queued for the
+    log file. The first record let through after a drop carries the number
+    of records suppressed in between.
+    """
+
+    def __init__(self, limits=None):
+        super(RateLimitFilter, self).__init__()
+        self._limits = LOG_RATE_LIMITS if limits is None else limits
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        limit = self._limits.get(category)
+        if limit is None or record.levelno >= logging.WARNING:
+            return True
+
+        now = time.time()
+        with self._lock:
+            state = self._state.setdefault(category, {"seen": 0, "window": now, "passed": 0, "dropped": 0})
+            state["seen"] += 1
+
+            if now - state["window"] >= limit["window_s"]:
+                state["window"] = now
+                state["passed"] = 0
+
+            if (state["seen"] - 1) % limit["sample"] or state["passed"] >= limit["burst"]:
+                state["dropped"] += 1
+                return False
+
+            state["passed"] += 1
+            dropped, state["dropped"] = state["dropped"], 0
+
+        if dropped:
+            record.msg = f"{record.getMessage()} (+{dropped} similar suppressed)"
+            record.args = None
+        return True
+
+
+def truncate(value, limit=MAX_LOGGED_VALUE):
+    """Shorten long strings for the log, keeping their length visible."""
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}... ({len(value)} chars)"
+    return value
+
+
+def loggable(data, limit=MAX_LOGGED_VALUE):
+    """Copy of a metadata dict with large values (base64 thumbnails) truncated."""
+    return {key: truncate(value, limit) for key, value in data.items()}
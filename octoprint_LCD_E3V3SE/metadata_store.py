@@ -0,0 +1,201 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    path        TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    mtime       REAL,
+    updated     REAL NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_fingerprint ON metadata (fingerprint);
+"""
+
+
+class MetadataStore(object):
+    """
+    Upload metadata in a small SQLite database, keyed by the full storage path
+    and tagged with the content fingerprint from the upload scan, so a copy or
+    an identical re-upload can reuse the metadata instead of being re-analysed.
+
+    Recently used entries are kept in an in-memory LRU. Lookups pass the file's
+    current mtime: an entry recorded for another mtime belongs to an older version
+    of the file and is treated as missing. Entries stored before the file reached
+    the disk (the preprocessor runs first) adopt the mtime of their first lookup.
+    """
+
+    def __init__(self, db_path, cache_size=64):
+        self.db_path = db_path
+        self.cache_size = cache_size
+
+        self._lock = threading.RLock()
+        self._cache = OrderedDict()  # path -> (fingerprint, mtime, metadata)
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+            self._conn.close()
+
+    # -----------------------
+    # LRU
+    # -----------------------
+    def _remember(self, path, entry):
+        self._cache[path] = entry
+        self._cache.move_to_end(path)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _forget(self, path):
+        self._cache.pop(path, None)
+
+    # -----------------------
+    # Access
+    # -----------------------
+    def put(self, path, metadata, fingerprint=None, mtime=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (path, fingerprint, mtime, updated, data) VALUES (?, ?, ?, ?, ?)",
+                (path, fingerprint, mtime, time.time(), json.dumps(metadata)),
+            )
+            self._conn.commit()
+            self._remember(path, (fingerprint, mtime, metadata))
+
+    def get(self, path, mtime=None):
+        """Metadata for path, or None if unknown or recorded for another version of the file."""
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is None:
+                row = self._conn.execute(
+                    "SELECT fingerprint, mtime, data FROM metadata WHERE path = ?", (path,)
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = (row[0], row[1], json.loads(row[2]))
+
+            fingerprint, stored_mtime, metadata = entry
+            if mtime is not None:
+                if stored_mtime is None:
+                    stored_mtime = mtime
+                    self._conn.execute("UPDATE metadata SET mtime = ? WHERE path = ?", (mtime, path))
+                    self._conn.commit()
+                elif stored_mtime != mtime:
+                    self._forget(path)
+                    return None
+
+            self._remember(path, (fingerprint, stored_mtime, metadata))
+            return metadata
+
+    def contains(self, path, mtime=None):
+        """True if get(path, mtime) would find an entry, without loading it."""
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is not None:
+                stored_mtime = entry[1]
+            else:
+                row = self._conn.execute("SELECT mtime FROM metadata WHERE path = ?", (path,)).fetchone()
+                if row is None:
+                    return False
+                stored_mtime = row[0]
+            return mtime is None or stored_mtime is None or stored_mtime == mtime
+
+    def find_by_fingerprint(self, fingerprint):
+        """Storage paths whose content matches fingerprint."""
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM metadata WHERE fingerprint = ?", (fingerprint,)).fetchall()
+            return [row[0] for row in rows]
+
+    # -----------------------
+    # Lifecycle
+    # -----------------------
+    def delete(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM metadata WHERE path = ?", (path,))
+            self._conn.commit()
+            self._forget(path)
+
+    def delete_folder(self, folder):
+        """Drop every entry below folder. Returns the number of entries removed."""
+        prefix = folder.rstrip("/") + "/"
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM metadata WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+            ).rowcount
+            self._conn.commit()
+            for path in [p for p in self._cache if p.startswith(prefix)]:
+                self._forget(path)
+            return removed
+
+    def move(self, source, destination):
+        """Re-key the entry of a moved file, replacing whatever destination had."""
+        with self._lock:
+            self._conn.execute("DELETE FROM metadata WHERE path = ?", (destination,))
+            self._conn.execute("UPDATE metadata SET path = ? WHERE path = ?", (destination, source))
+            self._conn.commit()
+            self._forget(source)
+            self._forget(destination)
+
+    def move_folder(self, source, destination):
+        """Re-key every entry below a moved folder. Returns the number of entries moved."""
+        src_prefix = source.rstrip("/") + "/"
+        dst_prefix = destination.rstrip("/") + "/"
+        with self._lock:
+            self.delete_folder(dst_prefix)
+            moved = self._conn.execute(
+                "UPDATE metadata SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?",
+                (dst_prefix, len(src_prefix) + 1, len(src_prefix), src_prefix),
+            ).rowcount
+            self._conn.commit()
+            for path in [p for p in self._cache if p.startswith(src_prefix)]:
+                self._forget(path)
+            return moved
+
+    def compact(self, max_entries=None, max_age_s=None, exists=None):
+        """
+        Garbage-collect the store: drop entries whose file is gone (exists(path)
+        returns False), entries of files not modified for max_age_s and those of
+        the least recently modified files beyond max_entries, then give the space
+        back to the file system. Ranking by the file's mtime (the write time until
+        it is known) keeps the same set a backfill limited the same way builds.
+        Returns the number of entries removed.
+        """
+        with self._lock:
+            stale = []
+            if exists is not None:
+                paths = [row[0] for row in self._conn.execute("SELECT path FROM metadata")]
+                stale = [(path,) for path in paths if not exists(path)]
+                self._conn.executemany("DELETE FROM metadata WHERE path = ?", stale)
+            removed = len(stale)
+
+            if max_age_s:
+                removed += self._conn.execute(
+                    "DELETE FROM metadata WHERE COALESCE(mtime, updated) < ?", (time.time() - max_age_s,)
+                ).rowcount
+
+            if max_entries:
+                removed += self._conn.execute(
+                    "DELETE FROM metadata WHERE path IN "
+                    "(SELECT path FROM metadata ORDER BY COALESCE(mtime, updated) DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                ).rowcount
+
+            self._conn.commit()
+            if removed:
+                self._cache.clear()
+                self._conn.execute("VACUUM")
+            return removed
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
@@ -0,0 +1,128 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import threading
+
+# Correction factors are looked up from the most to the least specific key.
+# A key is only trusted once it has this many finished prints behind it.
+#   file      same file printed before
+#   profile   same slicer and print profile
+#   slicer    same slicer, any profile
+MIN_SAMPLES = (("file", 1), ("profile", 2), ("slicer", 3))
+
+# actual/predicted ratios outside this range (aborted pauses, wrong estimates)
+# are clamped before they are averaged in
+RATIO_LIMITS = (0.5, 2.0)
+
+
+class PrintHistory(object):
+    """
+    Finished prints with the slicer's predicted and the actual duration, kept as
+    an append-only JSON-lines file. Every record updates an exponentially weighted
+    actual/predicted ratio per file, per slicer profile and per slicer, which is
+    the correction factor for the slicer's time estimates.
+
+    The file holds at most twice max_entries lines; past that it is rewritten with
+    the newest max_entries, so loading it is a bounded replay of short lines.
+    """
+
+    def __init__(self, path, max_entries=500, alpha=0.3):
+        self.path = path
+        self.max_entries = max_entries
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        self._records = []
+        self._factors = {}  # (kind, key) -> [ratio, samples]
+
+    @staticmethod
+    def _keys(record):
+        slicer = record.get("slicer") or "unknown"
+        profile = record.get("profile")
+        return (
+            ("file", record.get("file")),
+            ("profile", (slicer, profile) if profile else None),
+            ("slicer", slicer),
+        )
+
+    def _apply(self, record):
+        predicted = record.get("predicted_s") or 0
+        actual = record.get("actual_s") or 0
+        if predicted <= 0 or actual <= 0:
+            return
+        ratio = min(max(actual / predicted, RATIO_LIMITS[0]), RATIO_LIMITS[1])
+        for kind, key in self._keys(record):
+            if key is None:
+                continue
+            state = self._factors.get((kind, key))
+            if state is None:
+                self._factors[(kind, key)] = [ratio, 1]
+            else:
+                state[0] += self.alpha * (ratio - state[0])
+                state[1] += 1
+
+    def load(self):
+        """Replay the history file. Returns the number of records loaded."""
+        records = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A line cut short by a crash mid-append
+                        continue
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self._records = records
+            self._factors = {}
+            for record in records:
+                self._apply(record)
+            return len(records)
+
+    def record(self, predicted_s, actual_s, file=None, slicer=None, profile=None):
+        entry = {
+            "ts": int(time.time()),
+            "file": file,
+            "slicer": slicer,
+            "profile": profile,
+            "predicted_s": int(predicted_s),
+            "actual_s": int(actual_s),
+        }
+        with self._lock:
+            self._records.append(entry)
+            self._apply(entry)
+            if len(self._records) > 2 * self.max_entries:
+                self._rewrite()
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def _rewrite(self):
+        # Called with _lock held
+        self._records = self._records[-self.max_entries:]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._records:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def correction(self, file=None, slicer=None, profile=None):
+        """Factor to multiply the slicer's time estimate with, 1.0 without enough history."""
+        keys = dict(self._keys({"file": file, "slicer": slicer, "profile": profile}))
+        with self._lock:
+            for kind, min_samples in MIN_SAMPLES:
+                state = self._factors.get((kind, keys[kind]))
+                if state is not None and state[1] >= min_samples:
+                    return state[0]
+        return 1.0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
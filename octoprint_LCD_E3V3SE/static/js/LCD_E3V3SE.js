@@ -292,6 +292,11 @@ $(function () {
                 purgePopup(data.message);
             } else if (data.type === "close_purge_popup") {
                 closePurgePopup();
+            } else if (data.type === "analysis_done") {
+                console.log(">>> Upload analysis finished for", data.path, data.ok ? "" : "(failed)");
+                if (!data.ok) {
+                    showErrorPopup(data.message);
+                }
             }
         };
 
@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import sys
+import base64
+import hashlib
+from array import array
+
+from PIL import Image, ImageChops
+
+# Thumbnail geometry (width, height) expected by the firmware per command.
+# Anything else is the 26x240 banner format.
+THUMB_SIZES = {"M9001": (96, 96)}
+BANNER_SIZE = (240, 26)
+
+# Per-channel lookup tables with the same (c * 31) // 255 and (c * 63) // 255
+# scaling as before, already shifted into the high and low byte of a
+# big-endian RGB565 word. High and low parts never overlap, so adding the
+# bands is the same as OR-ing them.
+_R_HI = [((c * 31) // 255) << 3 for c in range(256)]
+_G_HI = [((c * 63) // 255) >> 3 for c in range(256)]
+_G_LO = [(((c * 63) // 255) & 0x07) << 5 for c in range(256)]
+_B_LO = [(c * 31) // 255 for c in range(256)]
+
+
+def thumb_geometry(o_cmd):
+    return THUMB_SIZES.get(o_cmd, BANNER_SIZE)
+
+
+def rgb565_bytes(image):
+    """Big-endian RGB565 bytes of the image, row-major, two bytes per pixel."""
+    r, g, b = image.convert("RGB").split()
+    hi = ImageChops.add(r.point(_R_HI), g.point(_G_HI))
+    lo = ImageChops.add(g.point(_G_LO), b.point(_B_LO))
+    return Image.merge("LA", (hi, lo)).tobytes()
+
+
+def rgb565_array(image):
+    """RGB565 values of the image as a compact array('H')."""
+    pixels = array("H", rgb565_bytes(image))
+    if sys.byteorder == "little":
+        pixels.byteswap()
+    return pixels
+
+
+def to_be_bytes(pixels):
+    """Big-endian bytes for an array('H') or a plain list of RGB565 values."""
+    if isinstance(pixels, (bytes, bytearray)):
+        return bytes(pixels)
+    pixels = array("H", pixels)
+    if sys.byteorder == "little":
+        pixels.byteswap()
+    return pixels.tobytes()
+
+
+def payload_hash(payload):
+    """Short content hash of a big-endian RGB565 payload, as announced with 'M9001 H <hash>'."""
+    return hashlib.blake2b(bytes(payload), digest_size=8).hexdigest()
+
+
+# -----------------------
+# M9001 wire encodings
+# -----------------------
+# Every chunk line is '<cmd> <tag> <y> <x> <payload>'. 'C' (hex, 4 chars per pixel)
+# is what every firmware understands; the others are only used once the firmware
+# listed them in its 'M9001 CAPS' reply.
+#   C  hex of the big-endian RGB565 bytes
+#   B  base64 of the big-endian RGB565 bytes (~2.7 chars per pixel)
+#   R  base64 of (count, hi, lo) run triples, count 1..255 (4 chars per run)
+ENCODING_TAGS = {"hex": "C", "b64": "B", "rle": "R"}
+
+
+def _hex_chunk(row, x, pixels, budget):
+    count = min(budget // 4, pixels - x)
+    return count, row[x * 2:(x + count) * 2].hex().upper()
+
+
+def _b64_chunk(row, x, pixels, budget):
+    # 4 chars per 3 bytes; every line is decoded on its own, so padding is fine
+    count = min((budget // 4) * 3 // 2, pixels - x)
+    return count, base64.b64encode(row[x * 2:(x + count) * 2]).decode("ascii")
+
+
+def _rle_chunk(row, x, pixels, budget):
+    runs = bytearray()
+    start = x
+    for _ in range(budget // 4):
+        if start >= pixels:
+            break
+        value = row[start * 2:start * 2 + 2]
+        end = start + 1
+        while end < pixels and end - start < 255 and row[end * 2:end * 2 + 2] == value:
+            end += 1
+        runs.append(end - start)
+        runs += value
+        start = end
+    return start - x, base64.b64encode(bytes(runs)).decode("ascii")
+
+
+_ENCODERS = {"hex": _hex_chunk, "b64": _b64_chunk, "rle": _rle_chunk}
+
+# What OctoPrint wraps around a numbered line: 'N<line> ' and '*<checksum>'.
+# Line numbers are assumed to stay below 8 digits.
+NUMBERED_OVERHEAD = len("N99999999 ") + len("*255")
+
+
+def chunk_budget(max_cmd_len, o_cmd, numbered, y, x):
+    """Payload chars that fit a '<cmd> T <y> <x> <payload>' line into the firmware's command buffer."""
+    header = len(f"{o_cmd} T {y} {x} ")
+    overhead = NUMBERED_OVERHEAD if numbered else 0
+    # The firmware buffer also holds the terminating NUL
+    return max_cmd_len - 1 - overhead - header
+
+
+def iter_row_chunks(row, encodings, budget, start=0):
+    """
+    Split one row of big-endian RGB565 bytes into (x, tag, payload) chunks.
+    Each chunk uses whichever of the allowed encodings covers the most pixels
+    within the payload character budget. budget is either a fixed number of
+    chars or a callable returning the budget for a chunk starting at x.
+    Chunking begins at pixel start.
+    """
+    budget_at = budget if callable(budget) else (lambda x: budget)
+    pixels = len(row) // 2
+    x = start
+    while x < pixels:
+        limit = budget_at(x)
+        best = None
+        for name in encodings:
+            count, payload = _ENCODERS[name](row, x, pixels, limit)
+            if count > 0 and (best is None or (count, -len(payload)) > (best[0], -len(best[2]))):
+                best = (count, ENCODING_TAGS[name], payload)
+        if best is None:
+            raise ValueError(f"Chunk budget {limit} is too small for a single pixel")
+        yield x, best[1], best[2]
+        x += best[0]